@@ -5,59 +5,817 @@
 import json
 import os
 import hashlib
+import threading
+import sqlite3
+import time
+import re
+import unicodedata
+import zlib
+import lzma
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # 非 Unix 平台只做进程内合并
+
 CACHE_DIR = os.path.expanduser("~/.openclaw/swarm/cache")
 
+# 进程内内存层容量 (条数 / 近似字节数)
+MEMORY_MAX_ENTRIES = 1024
+MEMORY_MAX_BYTES = 64 * 1024 * 1024
+
+# 每次 sweep 最多检查的条目数; 设置了容量上限时每写入多少次检查一次
+SWEEP_BATCH = 500
+EVICT_CHECK_EVERY = 100
+
+# 结果序列化后超过该字节数才压缩; 可选编码
+COMPRESS_THRESHOLD = 4096
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+def encode_result(result, codec=None, threshold=COMPRESS_THRESHOLD):
+    """序列化结果, 超过 threshold 时压缩; 返回 (codec, bytes), 未压缩时 codec 为 """""
+    data = json.dumps(result).encode()
+    if codec and len(data) >= threshold:
+        packed = CODECS[codec][0](data)
+        if len(packed) < len(data):
+            return codec, packed
+    return "", data
+
+def decode_result(codec, data):
+    if codec:
+        data = CODECS[codec][1](data)
+    return json.loads(data)
+
+# 任务规范化步骤, Cache(normalize=...) 按顺序应用; 也可以直接传入函数
+NORMALIZERS = {
+    "nfkc": lambda t: unicodedata.normalize("NFKC", t),  # 全角转半角等
+    "lower": lambda t: t.lower(),
+    "whitespace": lambda t: re.sub(r"\s+", " ", t).strip(),
+    "punct": lambda t: "".join(c for c in t if not unicodedata.category(c).startswith("P")),
+}
+# 默认只做不改变语义的规范化; 大小写、标点按需开启
+DEFAULT_NORMALIZE = ("nfkc", "whitespace")
+
+# 跨进程合并用的文件锁条带数: 键按哈希落到固定的锁文件上, 锁文件数量不随键增长
+LOCK_STRIPES = 256
+
+# 近似重复查找: 每个工作流最多索引的任务数
+NEAR_INDEX_MAX = 5000
+
+class MemoryTier:
+    """进程内 LRU, 按条数和近似字节数双重限制"""
+    
+    def __init__(self, max_entries=MEMORY_MAX_ENTRIES, max_bytes=MEMORY_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()  # name -> (created, result, size)
+        self._lock = threading.Lock()
+    
+    def get(self, name):
+        with self._lock:
+            item = self._items.get(name)
+            if item is not None:
+                self._items.move_to_end(name)
+            return item
+    
+    def put(self, name, created, result, size):
+        with self._lock:
+            self._discard(name)
+            if size > self.max_bytes:
+                return
+            self._items[name] = (created, result, size)
+            self.bytes += size
+            while len(self._items) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self.bytes -= evicted
+    
+    def discard(self, name):
+        with self._lock:
+            self._discard(name)
+    
+    def _discard(self, name):
+        item = self._items.pop(name, None)
+        if item is not None:
+            self.bytes -= item[2]
+    
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for name in [n for n in self._items if n.startswith(prefix)]:
+                self._discard(name)
+    
+    def discard_expired(self, cutoff):
+        with self._lock:
+            for name in [n for n, item in self._items.items() if item[0] < cutoff]:
+                self._discard(name)
+
+class FileBackend:
+    """每个 key 一个文件: {CACHE_DIR}/{workflow}_{key}.json
+    
+    第一行是 JSON 头 {"task", "created", "codec"}, 之后是结果的 (可能压缩的) 字节;
+    只读头即可判断过期, 不必解码结果。旧格式 (单个 JSON 对象, 含 "result") 照常可读。
+    文件 mtime 为写入时间, atime 在命中时显式更新, 作为 LRU 依据
+    """
+    
+    def __init__(self, compress=None, compress_threshold=COMPRESS_THRESHOLD):
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self._scan = None  # sweep 的续扫位置
+    
+    def _path(self, name):
+        return f"{CACHE_DIR}/{name}.json"
+    
+    @staticmethod
+    def _header(f):
+        """读文件头, 返回 dict; 旧格式文件返回完整对象"""
+        return json.loads(f.readline())
+    
+    def meta(self, name):
+        """只读头: 返回 {"task", "created", "codec"}, 不存在时返回 None"""
+        try:
+            with open(self._path(name), "rb") as f:
+                header = self._header(f)
+        except (OSError, ValueError):
+            return None
+        return {"task": header.get("task"), "created": datetime.fromisoformat(header["created"]),
+                "codec": header.get("codec", "")}
+    
+    def read(self, name, not_before=None):
+        """返回 (created, result), 不存在或无法解析时返回 None
+        
+        created 早于 not_before 时不解码结果, 返回 (created, None)
+        """
+        try:
+            f = open(self._path(name), "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            try:
+                header = self._header(f)
+                created = datetime.fromisoformat(header["created"])
+                if "result" in header:
+                    return created, header["result"]
+                if not_before is not None and created < not_before:
+                    return created, None
+                return created, decode_result(header.get("codec", ""), f.read())
+            except (ValueError, KeyError, zlib.error, lzma.LZMAError):
+                return None  # 损坏的文件 (如旧版本原地写入时中断) 按未命中处理
+    
+    def write(self, name, task, result, created):
+        """写入并返回落盘字节数
+        
+        先写临时文件再原子替换, 读者不会读到写了一半的文件
+        """
+        codec, data = encode_result(result, self.compress, self.compress_threshold)
+        header = json.dumps({"task": task, "created": created.isoformat(), "codec": codec})
+        payload = header.encode() + b"\n" + data
+        path = self._path(name)
+        # 临时文件名带上进程 / 线程, 同一个键的并发写入 (如后台刷新与 set) 互不覆盖
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        return len(payload)
+    
+    def touch(self, name):
+        path = self._path(name)
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+    
+    def delete(self, name):
+        path = self._path(name)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def _entries(self):
+        for entry in os.scandir(CACHE_DIR):
+            if entry.name.endswith(".json") and "_" in entry.name:
+                yield entry
+    
+    def usage(self):
+        """(条数, 字节数)"""
+        count = size = 0
+        for entry in self._entries():
+            count += 1
+            size += entry.stat().st_size
+        return count, size
+    
+    def sweep(self, cutoff, batch):
+        """续扫最多 batch 个文件, 删除写入早于 cutoff 的, 返回 (删除的 name, 字节数)"""
+        if self._scan is None:
+            self._scan = self._entries()
+        removed, reclaimed = [], 0
+        for _ in range(batch):
+            entry = next(self._scan, None)
+            if entry is None:
+                self._scan = None  # 一轮扫完, 下次从头开始
+                break
+            try:
+                st = entry.stat()
+                if datetime.fromtimestamp(st.st_mtime) < cutoff:
+                    os.remove(entry.path)
+                    removed.append(entry.name[:-len(".json")])
+                    reclaimed += st.st_size
+            except OSError:
+                continue
+        return removed, reclaimed
+    
+    def evict(self, max_entries, max_bytes):
+        """按最近访问时间 (atime) 淘汰到容量以内, 返回 (删除的 name, 字节数)"""
+        files = []
+        for entry in self._entries():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            files.append((st.st_atime, st.st_size, entry))
+        count, size = len(files), sum(f[1] for f in files)
+        files.sort(key=lambda f: f[0])
+        removed, reclaimed = [], 0
+        for _, file_size, entry in files:
+            if (max_entries is None or count <= max_entries) and (max_bytes is None or size <= max_bytes):
+                break
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            removed.append(entry.name[:-len(".json")])
+            reclaimed += file_size
+            count -= 1
+            size -= file_size
+        return removed, reclaimed
+    
+    def tasks(self, workflow, limit):
+        """最近写入的 limit 条 (name, task)"""
+        import glob
+        paths = glob.glob(f"{CACHE_DIR}/{workflow}_*.json")
+        paths.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+        for path in paths[:limit]:
+            meta = self.meta(os.path.basename(path)[:-len(".json")])
+            if meta is not None:
+                yield os.path.basename(path)[:-len(".json")], meta["task"]
+    
+    def clear(self, workflow=None):
+        import glob
+        for f in glob.glob(f"{CACHE_DIR}/{workflow or '*'}_*.json"):
+            os.remove(f)
+    
+    def expire(self, cutoff):
+        """删除 created 早于 cutoff 的条目, 返回删除条数"""
+        import glob
+        removed = 0
+        for path in glob.glob(f"{CACHE_DIR}/*_*.json"):
+            meta = self.meta(os.path.basename(path)[:-len(".json")])
+            if meta is None:
+                continue
+            if meta["created"] < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+class SQLiteBackend:
+    """单个 SQLite 库 (WAL 模式), created 上建索引, 过期清理是一次范围删除
+    
+    result 列存 JSON 文本, 压缩时存 BLOB, codec 列记录编码
+    """
+    
+    def __init__(self, path=None, compress=None, compress_threshold=COMPRESS_THRESHOLD):
+        self.path = path or f"{CACHE_DIR}/cache.db"
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+            name TEXT PRIMARY KEY,
+            workflow TEXT NOT NULL,
+            task TEXT,
+            result TEXT,
+            created REAL NOT NULL
+        )""")
+        # 旧库没有 size/accessed/codec 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(cache)")}
+        if "size" not in columns:
+            self._conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+        if "accessed" not in columns:
+            self._conn.execute("ALTER TABLE cache ADD COLUMN accessed REAL NOT NULL DEFAULT 0")
+        if "codec" not in columns:
+            self._conn.execute("ALTER TABLE cache ADD COLUMN codec TEXT NOT NULL DEFAULT ''")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON cache(created)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_workflow ON cache(workflow)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed)")
+        self._conn.commit()
+    
+    def meta(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT task, created, codec FROM cache WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return {"task": row[0], "created": datetime.fromtimestamp(row[1]), "codec": row[2]}
+    
+    def read(self, name, not_before=None):
+        # 过期行不取出 result
+        floor = not_before.timestamp() if not_before is not None else float("-inf")
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, codec, CASE WHEN created >= ? THEN result END FROM cache WHERE name = ?",
+                (floor, name)).fetchone()
+        if row is None:
+            return None
+        created, codec, data = row
+        if data is None:
+            return datetime.fromtimestamp(created), None
+        return datetime.fromtimestamp(created), decode_result(codec, data)
+    
+    def write(self, name, task, result, created):
+        codec, data = encode_result(result, self.compress, self.compress_threshold)
+        payload = data if codec else data.decode()
+        workflow = name.rsplit("_", 1)[0]
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (name, workflow, task, result, created, size, accessed, codec) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, workflow, task, payload, created.timestamp(), len(data), time.time(), codec))
+            self._conn.commit()
+        return len(data)
+    
+    def touch(self, name):
+        with self._lock:
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE name = ?", (time.time(), name))
+            self._conn.commit()
+    
+    def delete(self, name):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE name = ?", (name,))
+            self._conn.commit()
+    
+    def usage(self):
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return count, size
+    
+    def _delete_rows(self, rows):
+        self._conn.executemany("DELETE FROM cache WHERE name = ?", [(name,) for name, _ in rows])
+        self._conn.commit()
+        return [name for name, _ in rows], sum(size for _, size in rows)
+    
+    def sweep(self, cutoff, batch):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, size FROM cache WHERE created < ? LIMIT ?",
+                (cutoff.timestamp(), batch)).fetchall()
+            return self._delete_rows(rows)
+    
+    def evict(self, max_entries, max_bytes):
+        with self._lock:
+            count, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+            rows = []
+            for name, row_size in self._conn.execute("SELECT name, size FROM cache ORDER BY accessed"):
+                if (max_entries is None or count <= max_entries) and (max_bytes is None or size <= max_bytes):
+                    break
+                rows.append((name, row_size))
+                count -= 1
+                size -= row_size
+            return self._delete_rows(rows)
+    
+    def tasks(self, workflow, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, task FROM cache WHERE workflow = ? ORDER BY created DESC LIMIT ?",
+                (workflow, limit)).fetchall()
+        return rows
+    
+    def clear(self, workflow=None):
+        with self._lock:
+            if workflow:
+                self._conn.execute("DELETE FROM cache WHERE workflow = ?", (workflow,))
+            else:
+                self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+    
+    def expire(self, cutoff):
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM cache WHERE created < ?", (cutoff.timestamp(),))
+            self._conn.commit()
+        return cur.rowcount
+
+class NearIndex:
+    """按工作流划分的小型 bigram 倒排索引, 用 Jaccard 相似度找近似重复的任务"""
+    
+    def __init__(self, max_entries=NEAR_INDEX_MAX):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._grams = {}     # workflow -> OrderedDict(name -> bigram 集合)
+        self._postings = {}  # workflow -> {bigram: set(name)}
+    
+    @staticmethod
+    def bigrams(task):
+        text = task
+        for step in ("nfkc", "lower", "whitespace", "punct"):
+            text = NORMALIZERS[step](text)
+        return {text[i:i+2] for i in range(len(text) - 1)}
+    
+    def loaded(self, workflow):
+        return workflow in self._grams
+    
+    def load(self, workflow, items):
+        with self._lock:
+            self._grams[workflow] = OrderedDict()
+            self._postings[workflow] = {}
+        for name, task in reversed(list(items)):  # 旧的先加, 超出容量时先被挤掉
+            self.add(workflow, name, task)
+    
+    def add(self, workflow, name, task):
+        with self._lock:
+            if workflow not in self._grams:
+                return  # 尚未加载, 首次查找时整体加载
+            self._remove(workflow, name)
+            grams = self.bigrams(task)
+            self._grams[workflow][name] = grams
+            postings = self._postings[workflow]
+            for g in grams:
+                postings.setdefault(g, set()).add(name)
+            while len(self._grams[workflow]) > self.max_entries:
+                self._remove(workflow, next(iter(self._grams[workflow])))
+    
+    def remove(self, workflow, name):
+        with self._lock:
+            self._remove(workflow, name)
+    
+    def _remove(self, workflow, name):
+        grams = self._grams.get(workflow, {}).pop(name, None)
+        if grams is None:
+            return
+        postings = self._postings[workflow]
+        for g in grams:
+            names = postings.get(g)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del postings[g]
+    
+    def drop(self, workflow=None):
+        with self._lock:
+            if workflow is None:
+                self._grams.clear()
+                self._postings.clear()
+            else:
+                self._grams.pop(workflow, None)
+                self._postings.pop(workflow, None)
+    
+    def lookup(self, workflow, task, threshold):
+        """返回相似度 >= threshold 的 [(相似度, name)], 按相似度降序"""
+        query = self.bigrams(task)
+        if not query:
+            return []
+        with self._lock:
+            postings = self._postings.get(workflow, {})
+            overlap = {}
+            for g in query:
+                for name in postings.get(g, ()):
+                    overlap[name] = overlap.get(name, 0) + 1
+            grams = self._grams.get(workflow, {})
+            matches = []
+            for name, inter in overlap.items():
+                sim = inter / (len(query) + len(grams[name]) - inter)
+                if sim >= threshold:
+                    matches.append((sim, name))
+        matches.sort(reverse=True)
+        return matches
+
+class SingleFlight:
+    """相同 key 的并发调用只执行一次, 其余调用等待并共享同一结果 (或异常)"""
+    
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+    
+    def start(self, key, func):
+        """在后台线程中执行; 同一 key 已在执行时不重复启动, 返回是否启动"""
+        with self._lock:
+            if key in self._calls:
+                return False
+        
+        def run():
+            try:
+                self.do(key, func)
+            except Exception as e:
+                print(f"后台任务失败 ({key}): {e}")
+        
+        threading.Thread(target=run, daemon=True).start()
+        return True
+    
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+# 进程内共享, 与 Cache 使用同一套 key
+_flights = SingleFlight()
+# 当前线程已持有的跨进程条带锁; 嵌套的 get_or_compute 落到同一条带时不再 flock
+_held_stripes = threading.local()
+
+# 同一后端的所有 Cache 实例共享一个内存层和近似重复索引
+_memory = {"file": MemoryTier(), "sqlite": MemoryTier()}
+_near = {"file": NearIndex(), "sqlite": NearIndex()}
+
 class Cache:
-    def __init__(self, ttl_hours=24):
+    def __init__(self, ttl_hours=24, memory=True, backend="file", max_entries=None, max_bytes=None,
+                 normalize=DEFAULT_NORMALIZE, near_threshold=None, stale_hours=0, revalidate=None,
+                 compress="zlib", compress_threshold=COMPRESS_THRESHOLD):
+        """backend: "file" 每个 key 一个 JSON 文件; "sqlite" 单个 SQLite 库
+        max_entries / max_bytes: 磁盘容量上限, 超出时按最近访问时间淘汰 (LRU)
+        normalize: 计算 key 前对任务做的规范化步骤 (NORMALIZERS 中的名字或函数)
+        near_threshold: 精确未命中时复用 bigram Jaccard 相似度不低于该值的缓存; None 关闭
+        stale_hours / revalidate: 过期后 stale_hours 内仍返回旧结果, 同时在后台调用
+            revalidate(task, workflow) 刷新 (stale-while-revalidate); 未提供 revalidate 时照常过期
+        compress: 结果超过 compress_threshold 字节时的压缩编码 ("zlib" / "lzma"), None 不压缩
+        """
         self.ttl = timedelta(hours=ttl_hours)
+        self.grace = timedelta(hours=stale_hours)
+        self.revalidate = revalidate
+        self.memory = _memory[backend] if memory else None
         os.makedirs(CACHE_DIR, exist_ok=True)
+        backend_cls = SQLiteBackend if backend == "sqlite" else FileBackend
+        self.backend = backend_cls(compress=compress, compress_threshold=compress_threshold)
+        self.normalizers = [NORMALIZERS[n] if isinstance(n, str) else n for n in (normalize or ())]
+        self.near_threshold = near_threshold
+        self.near = _near[backend]
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {"expired": 0, "evicted": 0, "bytes_reclaimed": 0, "stale_hits": 0, "refreshes": 0}
+        self._writes = 0
+        self._sweeper = None
+        self._stop = threading.Event()
+    
+    def normalize(self, task):
+        for step in self.normalizers:
+            task = step(task)
+        return task
     
     def _key(self, task, workflow):
-        return hashlib.sha256(f"{workflow}:{task}".encode()).hexdigest()[:16]
+        return hashlib.sha256(f"{workflow}:{self.normalize(task)}".encode()).hexdigest()[:16]
     
-    def get(self, task, workflow):
-        """获取缓存"""
-        key = self._key(task, workflow)
-        path = f"{CACHE_DIR}/{workflow}_{key}.json"
+    def get(self, task, workflow, revalidate=None):
+        """获取缓存 (先查内存层, 未命中再读后端; 开启 near_threshold 时再找近似重复)
         
-        if os.path.exists(path):
-            with open(path) as f:
-                data = json.load(f)
-            
-            # 检查过期
-            created = datetime.fromisoformat(data["created"])
-            if datetime.now() - created < self.ttl:
-                return data["result"]
-            else:
-                os.remove(path)
+        revalidate: 覆盖构造时的刷新函数, 只对本次调用生效
+        """
+        revalidate = revalidate or self.revalidate
+        refresh = None
+        if revalidate is not None and self.grace:
+            refresh = lambda: self._compute(task, workflow, lambda: revalidate(task, workflow))
+        
+        result = self._get(f"{workflow}_{self._key(task, workflow)}", refresh)
+        if result is not None or self.near_threshold is None:
+            return result
+        
+        if not self.near.loaded(workflow):
+            self.near.load(workflow, self.backend.tasks(workflow, self.near.max_entries))
+        for _, name in self.near.lookup(workflow, task, self.near_threshold):
+            result = self._get(name, refresh)
+            if result is not None:
+                return result
+            self.near.remove(workflow, name)  # 已过期或被淘汰
+        return None
+    
+    def _get(self, name, refresh=None):
+        # 已过期 (含宽限期) 的条目不再返回
+        now = datetime.now()
+        cutoff = now - self.ttl - (self.grace if refresh is not None else timedelta(0))
+        item = self.memory.get(name) if self.memory is not None else None
+        if item is not None:
+            created, result, _ = item
+            if created <= cutoff:
+                # 只丢内存层副本: 后端可能已被其他进程写入新结果, 交给下面重读
+                self.memory.discard(name)
+                item = None
+        if item is None:
+            # 过期条目只读元数据, 不解码结果
+            stored = self.backend.read(name, not_before=cutoff)
+            if stored is None:
+                return None
+            created, result = stored
+        
+        # 检查过期; 宽限期内先返回旧结果, 后台刷新
+        age = now - created
+        if age < self.ttl or (refresh is not None and age < self.ttl + self.grace):
+            if item is None:
+                self.backend.touch(name)
+                if self.memory is not None:
+                    self.memory.put(name, created, result, len(json.dumps(result)))
+            if age >= self.ttl:
+                self.stats["stale_hits"] += 1
+                if _flights.start(name, refresh):
+                    self.stats["refreshes"] += 1
+            return result
+        
+        if self.memory is not None:
+            self.memory.discard(name)
+        self.backend.delete(name)
         return None
     
     def set(self, task, workflow, result):
-        """设置缓存"""
+        """设置缓存 (写穿: 同时写后端和内存层)"""
+        name = f"{workflow}_{self._key(task, workflow)}"
+        created = datetime.now()
+        self.backend.write(name, task, result, created)
+        
+        if self.memory is not None:
+            # 内存层存的是解码后的对象, 按未压缩的序列化长度计入容量 (与 get() 回填一致)
+            self.memory.put(name, created, result, len(json.dumps(result)))
+        self.near.add(workflow, name, task)
+        
+        self._writes += 1
+        if self._writes % EVICT_CHECK_EVERY == 0:
+            self.evict()
+        return True
+    
+    def get_or_compute(self, task, workflow, compute, cross_process=False):
+        """缓存未命中时执行 compute() 并写入缓存
+        
+        同一 (task, workflow) 的并发调用只执行一次 compute, 其余调用等待并拿到同一结果。
+        cross_process=True 时再用 CACHE_DIR/locks/ 下的文件锁跨进程合并:
+        拿到锁后先重查缓存, 其他进程刚算完的结果直接复用。
+        锁文件按键哈希分成 LOCK_STRIPES 条, 偶尔会让不同的键在跨进程时互相等待。
+        
+        嵌套规则: compute 里可以在同一线程内再调用 get_or_compute(cross_process=True),
+        落到已持有的条带时直接复用外层的锁; 但 compute 不能等待其他线程里的
+        cross_process 调用, 它们可能落到同一条带上而互相等待。
+        """
+        # 宽限期内的旧结果由 compute 在后台刷新
+        result = self.get(task, workflow, revalidate=lambda t, w: compute())
+        if result is not None:
+            return result
         key = self._key(task, workflow)
-        path = f"{CACHE_DIR}/{workflow}_{key}.json"
+        name = f"{workflow}_{key}"
         
-        data = {
-            "task": task,
-            "result": result,
-            "created": datetime.now().isoformat()
-        }
+        def run():
+            if not cross_process or fcntl is None:
+                return self._compute(task, workflow, compute)
+            
+            def locked():
+                cached = self.get(task, workflow)
+                if cached is not None:
+                    return cached
+                return self._compute(task, workflow, compute)
+            
+            stripe = int(key, 16) % LOCK_STRIPES
+            held = _held_stripes.__dict__.setdefault("stripes", set())
+            if stripe in held:
+                # 外层调用已持有该条带; 同进程用新的文件描述符再 flock 会自锁
+                return locked()
+            lock_dir = f"{CACHE_DIR}/locks"
+            os.makedirs(lock_dir, exist_ok=True)
+            with open(f"{lock_dir}/{stripe:03d}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                held.add(stripe)
+                try:
+                    return locked()
+                finally:
+                    held.discard(stripe)
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        
+        return _flights.do(name, run)
+    
+    def _compute(self, task, workflow, compute):
+        result = compute()
+        if result is not None:
+            self.set(task, workflow, result)
+        return result
+    
+    def _reclaimed(self, kind, removed, reclaimed):
+        if self.memory is not None:
+            for name in removed:
+                self.memory.discard(name)
+        self.stats[kind] += len(removed)
+        self.stats["bytes_reclaimed"] += reclaimed
+        return len(removed)
+    
+    def evict(self):
+        """超出容量上限时按 LRU 淘汰, 返回淘汰条数"""
+        if self.max_entries is None and self.max_bytes is None:
+            return 0
+        return self._reclaimed("evicted", *self.backend.evict(self.max_entries, self.max_bytes))
+    
+    def sweep(self, batch=SWEEP_BATCH):
+        """增量清理: 一次最多处理 batch 条过期条目, 然后检查容量; 返回本次统计"""
+        before = dict(self.stats)
+        cutoff = datetime.now() - self.ttl - self.grace
+        self._reclaimed("expired", *self.backend.sweep(cutoff, batch))
+        self.evict()
+        return {k: self.stats[k] - before[k] for k in self.stats}
+    
+    def start_sweeper(self, interval=60, batch=SWEEP_BATCH):
+        """启动后台清理线程 (守护线程)"""
+        if self._sweeper is not None:
+            return
+        self._stop.clear()
         
-        with open(path, "w") as f:
-            json.dump(data, f)
+        def run():
+            while not self._stop.is_set():
+                try:
+                    done = self.sweep(batch)
+                except Exception as e:
+                    print(f"缓存清理失败: {e}")
+                    done = {}
+                # 本批清满说明还有积压, 稍后立即继续
+                self._stop.wait(1 if done.get("expired", 0) >= batch else interval)
         
-        return True
+        self._sweeper = threading.Thread(target=run, daemon=True)
+        self._sweeper.start()
+    
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._stop.set()
+            self._sweeper.join()
+            self._sweeper = None
+    
+    def expire(self):
+        """删除所有过期 (且已过宽限期) 的条目, 返回删除条数"""
+        cutoff = datetime.now() - self.ttl - self.grace
+        if self.memory is not None:
+            self.memory.discard_expired(cutoff)
+        return self.backend.expire(cutoff)
     
     def clear(self, workflow=None):
         """清理缓存"""
-        import glob
-        pattern = f"{CACHE_DIR}/{workflow or '*'}_*.json"
-        for f in glob.glob(pattern):
-            os.remove(f)
+        self.backend.clear(workflow)
+        self.near.drop(workflow)
+        if self.memory is not None:
+            self.memory.discard_prefix(f"{workflow}_" if workflow else "")
         return True
 
+class StageCache:
+    """Agent 链单个阶段的输出缓存, key = (agent, 该阶段输入 prompt 的内容哈希)
+    
+    链的前几个阶段输入不变时直接回放, 失败重跑或只换后面的 Agent 不会重算前缀。
+    条目存在 "{workflow}.stages" 工作流下, 与整任务缓存互不干扰。
+    """
+    
+    def __init__(self, workflow, cache=None):
+        self.workflow = f"{workflow}.stages"
+        self.cache = cache or Cache()
+        self.hits = 0
+        self.misses = 0
+    
+    def _task(self, agent, prompt):
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        return f"{agent}:{digest}"
+    
+    def get(self, agent, prompt):
+        result = self.cache.get(self._task(agent, prompt), self.workflow)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+    
+    def set(self, agent, prompt, result):
+        return self.cache.set(self._task(agent, prompt), self.workflow, result)
+    
+    def clear(self):
+        return self.cache.clear(self.workflow)
+
 if __name__ == "__main__":
     c = Cache()
     print(f"缓存目录: {CACHE_DIR}")
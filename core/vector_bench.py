@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+VectorStore 性能基准 - 合成中英文任务语料, 输出 JSON 结果
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import vector_store
+from core.vector_store import VectorStore
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+TOPICS_ZH = ["人工智能", "机器学习", "具身认知", "区块链", "量子计算", "心理学", "教育", "医疗",
+             "自动驾驶", "推荐系统", "数据库", "微服务", "前端性能", "知识图谱", "大语言模型", "生物主权"]
+KINDS_ZH = ["文章", "科普", "评论", "技术文档", "教程", "故事", "报告", "方案"]
+FEATURES_ZH = ["用户登录", "支付", "搜索", "消息推送", "权限管理", "日志分析", "缓存", "文件上传"]
+TEMPLATES_ZH = [
+    "写一篇关于{topic}的{kind}",
+    "开发一个{feature}功能",
+    "用通俗的语言解释{topic}",
+    "为{feature}模块编写测试",
+    "分析{topic}的未来趋势, 写成{kind}",
+]
+TOPICS_EN = ["AI", "machine learning", "embodied cognition", "databases", "search", "caching",
+             "microservices", "LLM agents", "frontend performance", "knowledge graphs"]
+TEMPLATES_EN = [
+    "Write an article about {topic}",
+    "Implement {topic} support in the API",
+    "Explain {topic} to a beginner",
+    "Review the design of our {topic} module",
+]
+
+def make_task(rng):
+    """随机生成一条中文 (约 3/4) 或英文任务"""
+    if rng.random() < 0.75:
+        template = rng.choice(TEMPLATES_ZH)
+        task = template.format(topic=rng.choice(TOPICS_ZH), kind=rng.choice(KINDS_ZH),
+                               feature=rng.choice(FEATURES_ZH))
+    else:
+        task = rng.choice(TEMPLATES_EN).format(topic=rng.choice(TOPICS_EN))
+    # 加一个编号, 避免大量完全相同的任务被去重
+    return f"{task} #{rng.randrange(10**6)}"
+
+def make_result(rng, length=400):
+    words = TOPICS_ZH + KINDS_ZH + FEATURES_ZH
+    text = []
+    while sum(map(len, text)) < length:
+        text.append(rng.choice(words))
+    return "，".join(text)
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位 KB, macOS 单位字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def bench_size(size, queries=200, backend="dict", storage="json", seed=0):
+    """在临时目录中对单个规模跑全部测量"""
+    rng = random.Random(seed)
+    base = tempfile.mkdtemp(prefix="vector_bench_")
+    vector_store.VECTOR_DIR = base
+    workflow = "bench"
+    result = {"size": size, "backend": backend, "storage": storage}
+    try:
+        vs = VectorStore(workflow, backend=backend, storage=storage)
+    
+        # 批量导入
+        items = [(make_task(rng), make_result(rng)) for _ in range(size)]
+        start = time.perf_counter()
+        vs.add_many(items)
+        elapsed = time.perf_counter() - start
+        result["add_many_s"] = elapsed
+        result["add_many_per_s"] = size / elapsed if elapsed else 0.0
+        # 先落快照清空日志, 否则单条 add 的采样里会混进批量导入触发的后台压缩
+        vs.save()
+    
+        # 单条 add (追加日志)
+        samples = []
+        for _ in range(min(200, size)):
+            task, text = make_task(rng), make_result(rng)
+            start = time.perf_counter()
+            vs.add(task, text)
+            samples.append((time.perf_counter() - start) * 1000)
+        result["add_p50_ms"] = percentile(samples, 50)
+        result["add_p99_ms"] = percentile(samples, 99)
+    
+        # add + save (完整快照)
+        samples = []
+        for _ in range(3):
+            task, text = make_task(rng), make_result(rng)
+            start = time.perf_counter()
+            vs.add(task, text)
+            vs.save()
+            samples.append((time.perf_counter() - start) * 1000)
+        result["add_save_ms"] = percentile(samples, 50)
+    
+        # 冷加载
+        start = time.perf_counter()
+        vs = VectorStore(workflow, backend=backend, storage=storage)
+        result["load_ms"] = (time.perf_counter() - start) * 1000
+    
+        # 检索 (每次清空查询缓存, 测的是真实打分)
+        samples = []
+        for _ in range(queries):
+            query = make_task(rng).rsplit(" #", 1)[0]
+            vs.clear_query_cache()
+            start = time.perf_counter()
+            vs.search(query)
+            samples.append((time.perf_counter() - start) * 1000)
+        result["search_p50_ms"] = percentile(samples, 50)
+        result["search_p99_ms"] = percentile(samples, 99)
+    
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+    return result
+
+def run(sizes, queries, backend, storage, output):
+    """每个规模在独立子进程中运行, 峰值内存互不影响"""
+    results = []
+    for size in sizes:
+        print(f"⏱️ {size} 条 ...")
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", str(size),
+               "--queries", str(queries), "--backend", backend, "--storage", storage]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"  ❌ 失败: {proc.stderr.strip()[-300:]}")
+            results.append({"size": size, "error": proc.stderr.strip()[-300:]})
+            continue
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"  add_many {r['add_many_per_s']:.0f}/s, add+save {r['add_save_ms']:.1f}ms, "
+              f"load {r['load_ms']:.1f}ms, search p50 {r['search_p50_ms']:.2f}ms "
+              f"p99 {r['search_p99_ms']:.2f}ms, RSS {r['peak_rss_mb']:.0f}MB")
+        results.append(r)
+    
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "queries": queries,
+        "results": results
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ 结果已写入 {output}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VectorStore 性能基准")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="逗号分隔的条目数")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--backend", default="dict", choices=["dict", "numpy"])
+    parser.add_argument("--storage", default="json", choices=["json", "mmap"])
+    parser.add_argument("--output", default="vector_bench.json")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        print(json.dumps(bench_size(args.worker, args.queries, args.backend, args.storage)))
+    else:
+        sizes = [int(s) for s in args.sizes.split(",") if s]
+        run(sizes, args.queries, args.backend, args.storage, args.output)
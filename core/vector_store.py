@@ -6,37 +6,874 @@ import json
 import os
 import hashlib
 import re
-from datetime import datetime
-from collections import Counter
+from datetime import datetime, timedelta
+from collections import Counter, defaultdict, OrderedDict
 import math
+import heapq
+import operator
+import itertools
+import threading
+import zlib
+import random
+import mmap
+import struct
+import bisect
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # 非 Unix 平台只做进程内互斥
+
+VECTOR_DIR = os.path.expanduser("~/.openclaw/swarm")
+
+# 日志累计多少条记录后触发后台压缩
+COMPACT_EVERY = 1000
+
+# 查询结果 LRU 缓存容量
+QUERY_CACHE_SIZE = 256
+
+# numpy 打分后端的哈希特征维度
+FEATURE_DIM = 2 ** 18
+
+@contextmanager
+def _flock(path):
+    """跨进程互斥锁 (文件锁); fcntl 不可用时直接放行"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class MatrixIndex:
+    """哈希特征稀疏矩阵 (CSR), 一次矩阵-向量乘给所有条目打分"""
+    
+    def __init__(self, dim=FEATURE_DIM):
+        self.dim = dim
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros(0, dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self._pending = []  # 尚未并入矩阵的新行
+        self._rows = None   # 每个非零元所在的行号
+        self._dead = set()  # 已删除的行, 压缩时才真正移除
+    
+    def _hash(self, vec):
+        """把 {词: 权重} 哈希到固定维度并做 L2 归一化"""
+        cols = defaultdict(float)
+        for term, weight in vec.items():
+            cols[zlib.crc32(term.encode("utf-8")) % self.dim] += weight
+        norm = math.sqrt(sum(v**2 for v in cols.values()))
+        if norm == 0:
+            return {}
+        return {c: v / norm for c, v in cols.items()}
+    
+    def append(self, eid, vec):
+        self._pending.append((eid, self._hash(vec)))
+    
+    def _flush(self):
+        if not self._pending:
+            return
+        lengths = np.array([len(h) for _, h in self._pending], dtype=np.int64)
+        cols = [c for _, h in self._pending for c in h]
+        vals = [v for _, h in self._pending for v in h.values()]
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(lengths)])
+        self.indices = np.concatenate([self.indices, np.array(cols, dtype=np.int32)])
+        self.values = np.concatenate([self.values, np.array(vals, dtype=np.float32)])
+        self.ids = np.concatenate([self.ids, np.array([eid for eid, _ in self._pending], dtype=np.int64)])
+        self._pending = []
+        self._rows = None
+    
+    def remove(self, eid):
+        """标记删除一行 (ids 按插入顺序递增, 二分查找)
+        
+        还没并入矩阵的行直接从待并入列表中去掉, 不为一次删除重新拼接整个矩阵
+        """
+        if self._pending and eid >= self._pending[0][0]:
+            i = bisect.bisect_left(self._pending, eid, key=lambda p: p[0])
+            if i < len(self._pending) and self._pending[i][0] == eid:
+                del self._pending[i]
+            return
+        row = int(np.searchsorted(self.ids, eid))
+        if row < len(self.ids) and self.ids[row] == eid:
+            self._dead.add(row)
+    
+    def _purge(self):
+        """真正移除已标记删除的行"""
+        if not self._dead:
+            return
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[list(self._dead)] = False
+        rows = np.repeat(np.arange(len(self.ids)), np.diff(self.indptr))
+        self.indices = self.indices[keep[rows]]
+        self.values = self.values[keep[rows]]
+        self.indptr = np.concatenate([[0], np.cumsum(np.diff(self.indptr)[keep])]).astype(np.int64)
+        self.ids = self.ids[keep]
+        self._dead = set()
+        self._rows = None
+    
+    def id_list(self):
+        self._flush()
+        self._purge()
+        return self.ids.tolist()
+    
+    def top_k(self, vec, k):
+        """返回 [(id, 近似得分)], 按得分降序"""
+        self._flush()
+        query = self._hash(vec)
+        if not query or k <= 0 or not len(self.ids):
+            return []
+        
+        dense = np.zeros(self.dim, dtype=np.float32)
+        dense[list(query)] = list(query.values())
+        if self._rows is None:
+            self._rows = np.repeat(np.arange(len(self.ids)), np.diff(self.indptr))
+        scores = np.bincount(self._rows, weights=self.values * dense[self.indices], minlength=len(self.ids))
+        if self._dead:
+            scores[list(self._dead)] = 0
+        
+        cand = np.flatnonzero(scores > 0)
+        if len(cand) > k:
+            cand = cand[np.argpartition(-scores[cand], k - 1)[:k]]
+        cand = cand[np.argsort(-scores[cand], kind="stable")]
+        return [(int(self.ids[i]), float(scores[i])) for i in cand]
+    
+    def arrays(self):
+        """当前矩阵的快照 (数组只会被整体替换, 可在锁外写盘)"""
+        self._flush()
+        self._purge()
+        return {"dim": np.array(self.dim), "indptr": self.indptr, "indices": self.indices,
+                "values": self.values, "ids": self.ids}
+    
+    @staticmethod
+    def dump(arrays, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            m = cls(int(z["dim"]))
+            m.indptr = z["indptr"]
+            m.indices = z["indices"]
+            m.values = z["values"]
+            m.ids = z["ids"]
+        return m
+
+# MinHash/LSH 近似检索: LSH_BANDS 个 band, 每个 band LSH_ROWS 个哈希
+LSH_BANDS = 16
+LSH_ROWS = 4
+# 单个桶最多取多少候选: 模板化任务会挤进同一个大桶, 全取的话近似检索比精确还慢
+LSH_BUCKET_CAP = 256
+_LSH_PRIME = (1 << 31) - 1
+
+# bigram BM25 打分参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+class MinHashLSH:
+    """bigram 集合的 MinHash 签名按 band 分桶, 查询只取同桶条目作为候选"""
+    
+    def __init__(self, bands=LSH_BANDS, rows=LSH_ROWS):
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(42)
+        n = bands * rows
+        self._a = [rng.randrange(1, _LSH_PRIME) for _ in range(n)]
+        self._b = [rng.randrange(0, _LSH_PRIME) for _ in range(n)]
+        self.buckets = [{} for _ in range(bands)]
+    
+    def signature(self, shingles):
+        hashes = [zlib.crc32(s.encode("utf-8")) % _LSH_PRIME for s in shingles]
+        if np is not None:
+            h = np.array(hashes, dtype=np.int64)
+            a = np.array(self._a, dtype=np.int64)[:, None]
+            b = np.array(self._b, dtype=np.int64)[:, None]
+            return ((a * h + b) % _LSH_PRIME).min(axis=1).tolist()
+        return [min((a * h + b) % _LSH_PRIME for h in hashes)
+                for a, b in zip(self._a, self._b)]
+    
+    def _keys(self, shingles):
+        sig = self.signature(shingles)
+        for i in range(self.bands):
+            band = ",".join(map(str, sig[i * self.rows:(i + 1) * self.rows]))
+            yield i, format(zlib.crc32(band.encode()), "x")
+    
+    def add(self, eid, shingles):
+        if not shingles:
+            return
+        for i, key in self._keys(shingles):
+            self.buckets[i].setdefault(key, set()).add(eid)
+    
+    def remove(self, eid, shingles):
+        if not shingles:
+            return
+        for i, key in self._keys(shingles):
+            bucket = self.buckets[i].get(key)
+            if bucket is not None:
+                bucket.discard(eid)
+                if not bucket:
+                    del self.buckets[i][key]
+    
+    def candidates(self, shingles, bands=None, cap=LSH_BUCKET_CAP):
+        """探测前 bands 个 band 的桶 (默认全部), band 越少越快、召回越低
+        
+        超过 cap 的桶只取其中 cap 个: 大桶里是彼此几乎相同的条目, 取一部分即可代表
+        """
+        found = set()
+        if not shingles:
+            return found
+        limit = self.bands if bands is None else min(bands, self.bands)
+        for i, key in self._keys(shingles):
+            if i >= limit:
+                break
+            bucket = self.buckets[i].get(key, ())
+            if cap is not None and len(bucket) > cap:
+                bucket = itertools.islice(bucket, cap)
+            found.update(bucket)
+        return found
+    
+    def to_json(self, seq):
+        buckets = [{key: sorted(ids) for key, ids in band.items()} for band in self.buckets]
+        return {"seq": seq, "bands": self.bands, "rows": self.rows, "buckets": buckets}
+    
+    @classmethod
+    def from_json(cls, data):
+        lsh = cls(data["bands"], data["rows"])
+        lsh.buckets = [{key: set(ids) for key, ids in band.items()} for band in data["buckets"]]
+        return lsh
+
+# mmap 条目偏移表的定长记录: id, 偏移, task/result/timestamp/其他字段 的字节数
+_ENTRY_RECORD = struct.Struct("<qQIIII")
+_ENTRY_FIELDS = ("task", "result", "timestamp", "extra")
+
+class EntryFile:
+    """mmap 条目存储: <name>.dat 顺序存放 UTF-8 文本, <name>.idx 为定长偏移表"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._dat = self._map(f"{path}.dat")
+        self._idx = self._map(f"{path}.idx")
+    
+    @staticmethod
+    def _map(path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def __len__(self):
+        return len(self._idx) // _ENTRY_RECORD.size
+    
+    def _spans(self, row):
+        eid, offset, *lengths = _ENTRY_RECORD.unpack_from(self._idx, row * _ENTRY_RECORD.size)
+        spans = {}
+        for name, length in zip(_ENTRY_FIELDS, lengths):
+            spans[name] = (offset, length)
+            offset += length
+        return eid, spans
+    
+    def _text(self, span):
+        start, length = span
+        return self._dat[start:start + length].decode("utf-8")
+    
+    def field(self, row, key):
+        """只解码所需字段"""
+        eid, spans = self._spans(row)
+        if key == "id":
+            return eid
+        if key in spans and key != "extra":
+            text = self._text(spans[key])
+            return None if key == "timestamp" and not text else text
+        extra = self._text(spans["extra"])
+        if extra:
+            extra = json.loads(extra)
+            if key in extra:
+                return extra[key]
+        raise KeyError(key)
+    
+    def to_dict(self, row):
+        eid, spans = self._spans(row)
+        entry = {"id": eid, "task": self._text(spans["task"]), "result": self._text(spans["result"]),
+                 "timestamp": self._text(spans["timestamp"]) or None}
+        extra = self._text(spans["extra"])
+        if extra:
+            entry.update(json.loads(extra))
+        return entry
+    
+    def entries(self):
+        return [MmapEntry(self, row) for row in range(len(self))]
+    
+    @staticmethod
+    def write(entries, path):
+        """流式写出全部条目, 先写临时文件再改名"""
+        with open(f"{path}.dat.tmp", "wb") as dat, open(f"{path}.idx.tmp", "wb") as idx:
+            offset = 0
+            for entry in entries:
+                entry = entry.to_dict() if isinstance(entry, MmapEntry) else entry
+                extra = {k: v for k, v in entry.items() if k not in ("id", *_ENTRY_FIELDS)}
+                parts = [
+                    entry["task"].encode("utf-8"),
+                    entry["result"].encode("utf-8"),
+                    (entry.get("timestamp") or "").encode("utf-8"),
+                    json.dumps(extra, ensure_ascii=False).encode("utf-8") if extra else b"",
+                ]
+                dat.write(b"".join(parts))
+                idx.write(_ENTRY_RECORD.pack(entry["id"], offset, *map(len, parts)))
+                offset += sum(map(len, parts))
+        os.replace(f"{path}.dat.tmp", f"{path}.dat")
+        os.replace(f"{path}.idx.tmp", f"{path}.idx")
+
+class MmapEntry:
+    """EntryFile 中的一条记忆, 字段按需从 mmap 切片解码 (用法同 dict 条目)"""
+    __slots__ = ("_file", "_row")
+    
+    def __init__(self, file, row):
+        self._file = file
+        self._row = row
+    
+    def __getitem__(self, key):
+        return self._file.field(self._row, key)
+    
+    def get(self, key, default=None):
+        try:
+            value = self._file.field(self._row, key)
+        except KeyError:
+            return default
+        return default if value is None else value
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def to_dict(self):
+        return self._file.to_dict(self._row)
 
 class VectorStore:
-    def __init__(self, workflow):
+    # VectorStore.open() 的进程内共享实例
+    _instances = {}
+    _registry_lock = threading.Lock()
+    
+    def __init__(self, workflow, backend="dict", storage="json", ttl_hours=None, shard=None):
+        """backend: "dict" 倒排索引打分; "numpy" 稀疏矩阵打分 (需要 numpy)
+        storage: "json" 条目存于 vector.json; "mmap" 条目文本存于 mmap 文件, 按需读取
+        ttl_hours: 条目保留时长, 超时的条目在 add() / search() 时删除; None 表示永久保留
+        shard: 时间分片名 (如 "2026-10"), 数据存于 knowledge/shards/<shard>/
+        """
+        if backend == "numpy" and np is None:
+            raise ImportError("numpy 后端需要先安装 numpy")
         self.workflow = workflow
-        self.store_file = os.path.expanduser(f"~/.openclaw/swarm/{workflow}/knowledge/vector.json")
-        self.ngram_file = os.path.expanduser(f"~/.openclaw/swarm/{workflow}/knowledge/ngram.json")
+        self.backend = backend
+        self.storage = storage
+        self.ttl = timedelta(hours=ttl_hours) if ttl_hours else None
+        self.shard = shard
+        knowledge_dir = f"{VECTOR_DIR}/{workflow}/knowledge"
+        if shard:
+            knowledge_dir = f"{knowledge_dir}/shards/{shard}"
+        self.store_file = f"{knowledge_dir}/vector.json"
+        self.ngram_file = f"{knowledge_dir}/ngram.json"
+        self.index_file = f"{knowledge_dir}/index.json"
+        self.log_file = f"{knowledge_dir}/vector.log"
+        self.matrix_file = f"{knowledge_dir}/vector.npz"
+        self.lsh_file = f"{knowledge_dir}/lsh.json"
+        self.lock_file = f"{knowledge_dir}/vector.lock"
+        self.compact_lock_file = f"{knowledge_dir}/compact.lock"
+        self._lock = threading.RLock()
+        self._local = threading.local()  # 当前线程的写入临界区嵌套层数
+        self._compact_lock = threading.Lock()
+        self._batch_depth = 0
+        self._save_pending = False  # 写锁内调用了 save(), 退出最外层批量写入时补做
+        self._pending_lines = []
+        # 查询缓存: 条目带生成号, 库有任何变更后生成号递增, 旧结果即失效
+        self._generation = 0
+        self._query_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.load()
     
     def load(self):
-        if os.path.exists(self.store_file):
-            with open(self.store_file) as f:
-                self.data = json.load(f)
-        else:
-            self.data = {"entries": []}
+        """加载快照并重放日志
+        
+        其他进程可能正在压缩: 读取期间快照被替换或日志段被删除时从头重读
+        """
+        with self._lock:
+            while True:
+                stamp = self._fingerprint()
+                try:
+                    self._load()
+                except FileNotFoundError:
+                    continue
+                if self._fingerprint() == stamp:
+                    break
+            self._stamp = stamp
+    
+    def _load(self):
+        self._generation += 1
+        self.data = self._read_json(self.store_file, {"entries": []})
+        self.ngrams = self._read_json(self.ngram_file, {"corpus": {}})
+        self.index = self._read_json(self.index_file, None)
+        
+        # 旧数据没有 id, 按顺序补齐
+        next_id = self.data.get("next_id", 0)
+        for entry in self.data["entries"]:
+            if "id" not in entry:
+                entry["id"] = next_id
+                next_id += 1
+            else:
+                next_id = max(next_id, entry["id"] + 1)
+        self.data["next_id"] = next_id
+        # mmap 格式的条目在 entry_file 中, vector.json 只存元数据
+        if self.data.get("entry_file"):
+            path = os.path.join(os.path.dirname(self.store_file), self.data["entry_file"])
+            self.data["entries"] = EntryFile(path).entries() + self.data["entries"]
+        self.data.setdefault("seq", 0)
+        self.ngrams.setdefault("seq", 0)
+        self._by_id = {str(e["id"]): e for e in self.data["entries"]}
+        self._matrix = None
+        # LSH 分桶只在与快照同一 seq 时可用, 否则首次近似检索时重建
+        lsh = self._read_json(self.lsh_file, None)
+        self._lsh = MinHashLSH.from_json(lsh) if lsh and lsh["seq"] == self.data["seq"] else None
+        
+        # 重放快照之后追加的日志记录
+        self._seq = max(self.data["seq"], self.ngrams["seq"])
+        self._log_records = 0
+        for path in self._segment_files(sealed_only=True):
+            for record in self._read_log(path):
+                self._apply(record)
+                self._log_records += 1
+        self._log_offset = 0
+        self._log_ino = None
+        self._replay_log()
+        
+        # 索引缺失或与数据不一致时重建
+        if (not self.index or "maxima" not in self.index
+                or set(self.index.get("norms", {})) != set(self._by_id)):
+            self._rebuild_index()
+        
+        if self.backend == "numpy":
+            self._load_matrix()
+    
+    @classmethod
+    def open(cls, workflow, backend="dict", storage="json", ttl_hours=None, shard=None):
+        """获取进程内共享实例, 磁盘文件有变化时才重新加载"""
+        key = (workflow, backend, storage, ttl_hours, shard)
+        with cls._registry_lock:
+            vs = cls._instances.get(key)
+            if vs is None:
+                vs = cls._instances[key] = cls(workflow, backend, storage, ttl_hours, shard)
+                return vs
+        vs.reload_if_changed()
+        return vs
+    
+    @staticmethod
+    def shards(workflow):
+        """列出工作流下已有的时间分片"""
+        shard_dir = f"{VECTOR_DIR}/{workflow}/knowledge/shards"
+        if not os.path.isdir(shard_dir):
+            return []
+        return sorted(name for name in os.listdir(shard_dir)
+                      if os.path.isdir(os.path.join(shard_dir, name)))
+    
+    def _fingerprint(self):
+        """快照文件的 (inode, mtime, size); 当前日志按读取位置单独跟踪"""
+        stamp = []
+        for path in (self.store_file, self.ngram_file):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+    
+    def reload_if_changed(self):
+        """跟上其他实例 / 进程的写入, 返回是否有变化
+        
+        快照被重写 (压缩) 时完整重新加载; 只是日志追加了记录时只重放新增的尾部
+        """
+        with self._lock:
+            if self._fingerprint() != self._stamp:
+                self.load()
+                return True
+            try:
+                st = os.stat(self.log_file)
+            except FileNotFoundError:
+                if not self._log_offset:
+                    return False
+                self.load()  # 日志被封存, 快照即将更新
+                return True
+            if self._log_ino is not None and st.st_ino != self._log_ino or st.st_size < self._log_offset:
+                self.load()
+                return True
+            if st.st_size == self._log_offset:
+                return False
+            return self._replay_log() > 0
+    
+    @contextmanager
+    def _writer(self):
+        """写入临界区: 跨进程文件锁 + 实例锁, 最外层进入时先重放其他写者追加的记录,
+        保证分配的 seq / id 不与已落盘的记录冲突 (加锁顺序固定为文件锁 -> 实例锁)
+        """
+        if getattr(self._local, "depth", 0):
+            self._local.depth += 1
+            try:
+                with self._lock:
+                    yield
+            finally:
+                self._local.depth -= 1
+            return
+        with _flock(self.lock_file), self._lock:
+            self._local.depth = 1
+            try:
+                self.reload_if_changed()
+                yield
+            finally:
+                self._local.depth = 0
+    
+    def _load_matrix(self):
+        """加载 vector.npz; 只缺尾部新条目时补齐, 否则重建"""
+        ids = [e["id"] for e in self.data["entries"]]
+        matrix = MatrixIndex.load(self.matrix_file) if os.path.exists(self.matrix_file) else None
+        if matrix is not None:
+            known = matrix.id_list()
+            if ids[:len(known)] != known:
+                matrix = None
+        if matrix is None:
+            matrix, known = MatrixIndex(), []
+        for entry in self.data["entries"][len(known):]:
+            matrix.append(entry["id"], self._tf(entry["task"]))
+        self._matrix = matrix
+    
+    def _read_json(self, path, default):
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return default
+    
+    def _segment_files(self, sealed_only=False):
+        """已封存的日志段 (按序号) + 当前日志"""
+        log_dir = os.path.dirname(self.log_file)
+        prefix = os.path.basename(self.log_file) + "."
+        sealed = []
+        if os.path.isdir(log_dir):
+            for name in os.listdir(log_dir):
+                if name.startswith(prefix) and name[len(prefix):].isdigit():
+                    sealed.append(os.path.join(log_dir, name))
+        sealed.sort()
+        if not sealed_only and os.path.exists(self.log_file):
+            sealed.append(self.log_file)
+        return sealed
+    
+    def _read_log(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的尾行
+                    continue
+    
+    def _replay_log(self):
+        """应用当前日志中 _log_offset 之后的完整记录, 返回条数
+        
+        写了一半的尾行 (可能是其他进程正在写) 不消费, 下次从同一位置再读
+        """
+        try:
+            with open(self.log_file, "rb") as f:
+                self._log_ino = os.fstat(f.fileno()).st_ino
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        end = data.rfind(b"\n") + 1
+        count = 0
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 崩溃时写了一半、之后又被追加覆盖的行
+            self._apply(record)
+            self._log_records += 1
+            count += 1
+        self._log_offset += end
+        return count
+    
+    def _repair_tail(self):
+        """截掉当前日志中写了一半的尾行, 避免后续追加与其粘连 (只在写锁内调用)"""
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, "rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+    
+    def _apply(self, record):
+        """把一条日志记录应用到内存 (按各快照的 seq 跳过已包含的部分)"""
+        seq = record["seq"]
+        self._seq = max(self._seq, seq)
+        self._generation += 1
+        op = record["op"]
         
-        if os.path.exists(self.ngram_file):
-            with open(self.ngram_file) as f:
-                self.ngrams = json.load(f)
+        if seq > self.data["seq"]:
+            if op == "add":
+                entry = record["entry"]
+                self.data["entries"].append(entry)
+                self.data["next_id"] = max(self.data["next_id"], entry["id"] + 1)
+                self._by_id[str(entry["id"])] = entry
+                if self.index is not None:
+                    self._index_entry(entry)
+                if self._matrix is not None:
+                    self._matrix.append(entry["id"], self._tf(entry["task"]))
+                if self._lsh is not None:
+                    self._lsh.add(entry["id"], self._get_ngrams(entry["task"], 2))
+            elif op == "delete":
+                entry = self._by_id.get(str(record["id"]))
+                if entry is not None:
+                    self._remove_entry(entry)
+            elif op == "clear":
+                self.data["entries"] = []
+                self._by_id = {}
+                # 重放其他进程的 clear 时不会再走 _load(), 这里直接换成空索引
+                self._rebuild_index()
+                self._matrix = MatrixIndex() if self.backend == "numpy" else None
+                self._lsh = None
+            self.data["seq"] = seq
+        
+        if seq > self.ngrams["seq"]:
+            if op == "add":
+                for ng in self._get_ngrams(record["entry"]["task"], 2):
+                    self.ngrams["corpus"][ng] = self.ngrams["corpus"].get(ng, 0) + 1
+            elif op == "delete":
+                corpus = self.ngrams["corpus"]
+                for ng in self._get_ngrams(record["task"], 2):
+                    if corpus.get(ng, 0) > 1:
+                        corpus[ng] -= 1
+                    else:
+                        corpus.pop(ng, None)
+            elif op == "clear":
+                self.ngrams["corpus"] = {}
+            self.ngrams["seq"] = seq
+    
+    def _remove_entry(self, entry):
+        """从条目列表和各索引中增量移除一条记忆"""
+        eid = entry["id"]
+        entries = self.data["entries"]
+        # id 按追加顺序递增, 二分定位
+        i = bisect.bisect_left(entries, eid, key=lambda e: e["id"])
+        if i < len(entries) and entries[i]["id"] == eid:
+            del entries[i]
+        else:
+            entries[:] = [e for e in entries if e["id"] != eid]
+        del self._by_id[str(eid)]
+        if self.index is not None:
+            self._unindex_entry(entry)
+        if self._matrix is not None:
+            self._matrix.remove(eid)
+        if self._lsh is not None:
+            self._lsh.remove(eid, self._get_ngrams(entry["task"], 2))
+    
+    def _append(self, op, **fields):
+        """追加一条日志记录并应用, 只写新增内容"""
+        record = {"seq": self._seq + 1, "op": op, **fields}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        if self._batch_depth:
+            self._pending_lines.append(line)
         else:
-            self.ngrams = {"corpus": {}}
+            self._write_log([line])
+        self._apply(record)
+        self._log_records += 1
+    
+    def _write_log(self, lines):
+        os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+        self._repair_tail()
+        with open(self.log_file, "ab") as f:
+            f.write("".join(lines).encode("utf-8"))
+            # 自己的写入不触发重放
+            self._log_offset = f.tell()
+            self._log_ino = os.fstat(f.fileno()).st_ino
+    
+    @contextmanager
+    def batch(self):
+        """批量写入: 期间的 add 只更新内存, 退出时一次性写入日志 (全程持有写锁)"""
+        with self._writer():
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._pending_lines:
+                    lines, self._pending_lines = self._pending_lines, []
+                    self._write_log(lines)
+        if self._save_pending and not getattr(self._local, "depth", 0):
+            self.save()
+        else:
+            self._maybe_compact()
+    
+    def _rebuild_index(self):
+        """根据全部条目重建倒排索引"""
+        self.index = {"postings": {}, "norms": {}, "maxima": {}, "bigrams": {}, "lengths": {}, "hashes": {}}
+        for entry in self.data["entries"]:
+            self._index_entry(entry)
+    
+    def _index_entry(self, entry):
+        """把单条记忆写入倒排索引 (词 -> {id: 权重}) 并记录向量模长
+        
+        maxima 记录每个词在所有条目中归一化权重 (权重 / 模长) 的最大值, 作为剪枝上界;
+        删除条目时不回调, 上界只会偏松。
+        同时维护 bigram 倒排表 (bigram -> {id: 词频}) 和条目长度, 供 BM25 使用
+        """
+        eid = str(entry["id"])
+        vec = self._tf(entry["task"])
+        postings = self.index["postings"]
+        maxima = self.index["maxima"]
+        norm = math.sqrt(sum(v**2 for v in vec.values()))
+        for term, weight in vec.items():
+            postings.setdefault(term, {})[eid] = weight
+            if weight / norm > maxima.get(term, 0.0):
+                maxima[term] = weight / norm
+        self.index["norms"][eid] = norm
+        
+        tokens = self._tokenize(entry["task"])
+        grams = Counter(''.join(tokens[i:i+2]) for i in range(len(tokens) - 1))
+        bigrams = self.index["bigrams"]
+        for gram, tf in grams.items():
+            bigrams.setdefault(gram, {})[eid] = tf
+        self.index["lengths"][eid] = sum(grams.values())
+        self.index["hashes"][self._task_hash(entry["task"])] = entry["id"]
+    
+    def _unindex_entry(self, entry):
+        """_index_entry 的逆操作"""
+        eid = str(entry["id"])
+        task = entry["task"]
+        tokens = self._tokenize(task)
+        for table, terms in (("postings", set(tokens)),
+                             ("bigrams", self._get_ngrams(task, 2))):
+            postings = self.index[table]
+            for term in terms:
+                ids = postings.get(term)
+                if ids is not None:
+                    ids.pop(eid, None)
+                    if not ids:
+                        del postings[term]
+        self.index["norms"].pop(eid, None)
+        self.index["lengths"].pop(eid, None)
+        task_hash = self._task_hash(task)
+        if self.index["hashes"].get(task_hash) == entry["id"]:
+            del self.index["hashes"][task_hash]
+    
+    def _task_hash(self, task):
+        return hashlib.sha256(task.encode()).hexdigest()[:16]
     
     def save(self):
-        os.makedirs(os.path.dirname(self.store_file), exist_ok=True)
-        with open(self.store_file, 'w') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        """同步压缩: 写出完整快照并删除已合并的日志段
+        
+        在 batch() 内调用时推迟到批量写入结束: 此时已持有写锁, 压缩再去拿锁会自锁
+        """
+        if getattr(self._local, "depth", 0):
+            self._save_pending = True
+            return
+        self._save_pending = False
+        with self._compact_lock, _flock(self.compact_lock_file):
+            self._compact()
+    
+    def _maybe_compact(self):
+        """日志过长时在后台线程压缩"""
+        if self._log_records < COMPACT_EVERY:
+            return
+        if not self._compact_lock.acquire(blocking=False):
+            return  # 已有压缩在进行
         
-        with open(self.ngram_file, 'w') as f:
-            json.dump(self.ngrams, f, ensure_ascii=False, indent=2)
+        def run():
+            try:
+                # 其他进程同时压缩时排队, 避免两份快照交错、误删对方未合并的日志段
+                with _flock(self.compact_lock_file):
+                    self._compact()
+            finally:
+                self._compact_lock.release()
+        threading.Thread(target=run, daemon=True).start()
+    
+    def _compact(self):
+        # 持写锁期间先跟上其他写者, 再封存当前日志并序列化快照, 之后的写入进入新日志
+        with _flock(self.lock_file), self._lock:
+            self.reload_if_changed()
+            seq = self._seq
+            self.data["seq"] = seq
+            self.ngrams["seq"] = seq
+            if os.path.exists(self.log_file):
+                os.replace(self.log_file, f"{self.log_file}.{seq:012d}")
+            self._log_records = 0
+            self._log_offset = 0
+            self._log_ino = None
+            
+            meta = {k: v for k, v in self.data.items() if k != "entry_file"}
+            entries = None
+            if self.storage == "mmap":
+                entries = list(self.data["entries"])
+                meta.update(entries=[], entry_file=f"entries.{seq:012d}")
+            snapshot = [
+                (self.store_file, json.dumps(meta, ensure_ascii=False, indent=2,
+                                             default=MmapEntry.to_dict)),
+                (self.ngram_file, json.dumps(self.ngrams, ensure_ascii=False, indent=2)),
+                (self.index_file, json.dumps(self.index, ensure_ascii=False)),
+            ]
+            if self._lsh is not None:
+                snapshot.append((self.lsh_file, json.dumps(self._lsh.to_json(seq))))
+            matrix = self._matrix.arrays() if self._matrix is not None else None
+        
+        knowledge_dir = os.path.dirname(self.store_file)
+        os.makedirs(knowledge_dir, exist_ok=True)
+        if entries is not None:
+            EntryFile.write(entries, os.path.join(knowledge_dir, meta["entry_file"]))
+        for path, text in snapshot:
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)
+        if matrix is not None:
+            MatrixIndex.dump(matrix, self.matrix_file)
+        
+        # 快照已落盘, 删除其覆盖的日志段和旧条目文件
+        for path in self._segment_files():
+            suffix = path.rsplit(".", 1)[-1]
+            if path != self.log_file and int(suffix) <= seq:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        for name in os.listdir(knowledge_dir):
+            if name.startswith("entries.") and not name.startswith(f"{meta.get('entry_file')}."):
+                try:
+                    os.remove(os.path.join(knowledge_dir, name))
+                except FileNotFoundError:
+                    pass
+        
+        with self._lock:
+            if entries is not None:
+                self._swap_entries(EntryFile(os.path.join(knowledge_dir, meta["entry_file"])))
+            else:
+                self.data.pop("entry_file", None)
+            self._stamp = self._fingerprint()
+    
+    def _swap_entries(self, entry_file):
+        """压缩后把内存中的条目换成新 mmap 文件里的视图, 释放文本内存"""
+        self.data["entry_file"] = os.path.basename(entry_file.path)
+        views = {str(e["id"]): e for e in entry_file.entries()}
+        entries = self.data["entries"]
+        for i, entry in enumerate(entries):
+            view = views.get(str(entry["id"]))
+            if view is not None:
+                entries[i] = view
+                self._by_id[str(entry["id"])] = view
     
     def _tokenize(self, text):
         """中文分词 (简单按字符)"""
@@ -50,6 +887,8 @@ class VectorStore:
     def _tf(self, text):
         """计算词频"""
         tokens = self._tokenize(text)
+        if not tokens:
+            return {}
         counter = Counter(tokens)
         total = len(tokens)
         return {k: v/total for k, v in counter.items()}
@@ -68,51 +907,330 @@ class VectorStore:
             return 0.0
         return dot / (mag1 * mag2)
     
-    def add(self, task, result):
-        """添加记忆"""
-        entry = {
-            "task": task,
-            "result": result[:500],  # 截断
-            "timestamp": datetime.now().isoformat()
-        }
-        self.data["entries"].append(entry)
+    def add(self, task, result, dedup=True):
+        """添加记忆 (追加一条日志记录, 不重写整个库)
         
-        # 更新N-gram语料库
-        ngrams = self._get_ngrams(task, 2)
-        for ng in ngrams:
-            if ng not in self.ngrams["corpus"]:
-                self.ngrams["corpus"][ng] = 0
-            self.ngrams["corpus"][ng] += 1
+        dedup=True 时相同任务只保留最新的一条
+        """
+        with self._writer():
+            if self.ttl:
+                self.expire()
+            if dedup:
+                old = self.index["hashes"].get(self._task_hash(task))
+                if old is not None:
+                    self._delete(old)
+            entry = {
+                "id": self.data["next_id"],
+                "task": task,
+                "result": result[:500],  # 截断
+                "timestamp": datetime.now().isoformat()
+            }
+            # 条目、索引与N-gram语料库在 _apply 中一并更新
+            self._append("add", entry=entry)
+        if not self._batch_depth:
+            self._maybe_compact()
+    
+    def add_many(self, items, dedup=True):
+        """批量添加 [(task, result), ...], 只落盘一次"""
+        count = 0
+        with self.batch():
+            for task, result in items:
+                self.add(task, result, dedup)
+                count += 1
+        return count
+    
+    def delete(self, eid):
+        """删除一条记忆, 返回是否存在"""
+        with self._writer():
+            deleted = self._delete(eid)
+        if deleted and not self._batch_depth:
+            self._maybe_compact()
+        return deleted
+    
+    def _delete(self, eid):
+        entry = self._by_id.get(str(eid))
+        if entry is None:
+            return False
+        # 记录里带上 task, 重放时才能回退 N-gram 语料库计数
+        self._append("delete", id=entry["id"], task=entry["task"])
+        return True
+    
+    def expire(self):
+        """删除超过 ttl 的条目, 返回删除条数"""
+        if not self.ttl:
+            return 0
+        with self._writer():
+            expired = self._expired()
+            for eid in expired:
+                self._delete(eid)
+        return len(expired)
+    
+    def _expired(self):
+        """超过 ttl 的条目 id
         
-        self.save()
+        条目按时间顺序追加, 只需从头检查到第一条未过期的;
+        没有时间戳的旧条目跳过 (不算过期, 也不挡住后面的检查)
+        """
+        cutoff = (datetime.now() - self.ttl).isoformat()
+        expired = []
+        for entry in self.data["entries"]:
+            timestamp = entry.get("timestamp")
+            if not timestamp:
+                continue
+            if timestamp >= cutoff:
+                break
+            expired.append(entry["id"])
+        return expired
+    
+    def search(self, query, top_k=5, approx=False, bands=None, scoring="cosine"):
+        """搜索相似记忆 (只对与查询共享字符的候选打分)
+        
+        approx=True 时走 MinHash/LSH 近似检索, bands 为探测的 band 数:
+        越少越快, 召回越低; 默认探测全部 LSH_BANDS 个
+        scoring="bm25" 时按 bigram BM25 打分, 用 ngram 语料库的文档频率压低常见字
+        
+        结果按 (小写查询, 参数) 缓存, 库变更后自动失效
+        """
+        if self.ttl:
+            # 只读的库不会调用 add(), 过期条目在这里删除 (删除会使查询缓存失效)
+            with self._lock:
+                stale = bool(self._expired())
+            if stale:
+                self.expire()
+        # 打分用原始查询; 缓存键只做不影响打分的规范化 (分词本身就转小写, 空白则计入词频)
+        key = (query.lower(), top_k, approx, bands, scoring)
+        # 与 add / delete / load 共用实例锁: 打分期间索引和查询缓存不会被其他线程改动
+        with self._lock:
+            generation = self._generation
+            cached = self._query_cache.get(key)
+            if cached is not None and cached[0] == generation:
+                self._query_cache.move_to_end(key)
+                self.cache_hits += 1
+                return [dict(r) for r in cached[1]]
+            
+            self.cache_misses += 1
+            results = self._search(query, top_k, approx, bands, scoring)
+            self._query_cache[key] = (generation, results)
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+            return [dict(r) for r in results]
+    
+    def cache_stats(self):
+        """查询缓存命中统计"""
+        with self._lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / total if total else 0.0,
+                "size": len(self._query_cache)
+            }
+    
+    def clear_query_cache(self):
+        """清空查询缓存和命中统计"""
+        with self._lock:
+            self._query_cache.clear()
+            self.cache_hits = self.cache_misses = 0
     
-    def search(self, query, top_k=5):
-        """搜索相似记忆"""
+    def _search(self, query, top_k, approx, bands, scoring):
         if not self.data["entries"]:
             return []
+        if scoring == "bm25":
+            return self._search_bm25(query, top_k)
+        if approx:
+            return self._search_lsh(query, top_k, bands)
+        if self.backend == "numpy":
+            return self._search_matrix(query, top_k)
         
+        return self._search_cosine(query, top_k)
+    
+    def _search_cosine(self, query, top_k):
+        """精确余弦 + MaxScore 式剪枝
+        
+        查询词按倒排表从短到长累加点积。只含剩余词的条目得分不超过
+        min(各词上界之和, 剩余查询权重的 L2 范数) (后者由 Cauchy-Schwarz 得到);
+        该上界不超过当前第 top_k 名的精确得分时, 剩余的长倒排表不再扫描,
+        已有候选按 (部分得分 + 上界) 从高到低补全精确得分, 上界低于第 top_k 名即停止。
+        """
         query_vec = self._tf(query)
+        query_norm = math.sqrt(sum(v**2 for v in query_vec.values()))
+        if query_norm == 0:
+            return []
+        
+        postings = self.index["postings"]
+        maxima = self.index["maxima"]
+        terms = []
+        for term, qw in query_vec.items():
+            ids = postings.get(term)
+            if ids:
+                qw /= query_norm
+                terms.append((len(ids), term, qw, ids, qw * maxima.get(term, 1.0)))
+        terms.sort()
+        # rest[i]: 只含第 i 个及之后的词的条目的得分上界
+        rest = [0.0] * (len(terms) + 1)
+        bound = squares = 0.0
+        for i in range(len(terms) - 1, -1, -1):
+            bound += terms[i][4]
+            squares += terms[i][2] ** 2
+            rest[i] = min(bound, math.sqrt(squares))
+        
+        norms = self.index["norms"]
+        heap = []      # 当前前 top_k 名 (score, eid) 的小顶堆
+        scored = set()
+        
+        def offer(eid, partial, start):
+            # partial 为前 start 个词的得分, 补全之后的词得到精确余弦
+            if eid in scored:
+                return
+            inv = 1.0 / norms[eid]
+            for _, _, qw, ids, _ in terms[start:]:
+                w = ids.get(eid)
+                if w is not None:
+                    partial += qw * w * inv
+            scored.add(eid)
+            if len(heap) < top_k:
+                heapq.heappush(heap, (partial, eid))
+            elif partial > heap[0][0]:
+                heapq.heapreplace(heap, (partial, eid))
+        
+        def raise_threshold(candidates, done, normalized):
+            # 部分得分最高的几条先算出精确得分, 抬高第 top_k 名的门槛
+            for eid, value in heapq.nlargest(top_k, candidates.items(), key=operator.itemgetter(1)):
+                offer(eid, value if normalized else value / norms[eid], done)
+            return heap[0][0] if len(heap) >= top_k else 0.0
+        
+        # 第一阶段: 扫描倒排表累加点积, 直到只含剩余词的新条目不可能进入前 top_k
+        dots = {}
+        done = 0
+        theta = 0.0
+        while done < len(terms):
+            _, _, qw, ids, _ = terms[done]
+            for eid, w in ids.items():
+                dots[eid] = dots.get(eid, 0.0) + qw * w
+            done += 1
+            theta = raise_threshold(dots, done, False)
+            if rest[done] <= theta:
+                break
         
+        # 第二阶段: 只为已有候选补全剩余词 (部分得分已按模长归一化),
+        # 部分得分 + 剩余上界不超过门槛的候选随时淘汰
+        cut = theta - rest[done]
+        partials = {eid: dot / norms[eid] for eid, dot in dots.items()}
+        partials = {eid: p for eid, p in partials.items() if p > cut}
+        while done < len(terms) and partials:
+            _, _, qw, ids, _ = terms[done]
+            cut = theta - rest[done + 1]
+            if len(partials) < len(ids):
+                get = ids.get
+                partials = {eid: p for eid, p in (
+                    (eid, p + qw * get(eid, 0.0) / norms[eid]) for eid, p in partials.items()) if p > cut}
+            else:
+                for eid, w in ids.items():
+                    if eid in partials:
+                        partials[eid] += qw * w / norms[eid]
+                partials = {eid: p for eid, p in partials.items() if p > cut}
+            done += 1
+            theta = raise_threshold(partials, done, True)
+        for eid, p in partials.items():
+            if p > theta - rest[done]:
+                offer(eid, p, done)
+        
+        return [self._result(self._by_id[eid], sim)
+                for sim, eid in sorted(heap, key=lambda x: x[0], reverse=True) if sim > 0]
+    
+    def _search_bm25(self, query, top_k):
+        """bigram BM25: idf 来自 ngrams["corpus"], 长度归一化按条目长度计算"""
+        grams = self._get_ngrams(query, 2)
+        if not grams:
+            return []
+        
+        corpus = self.ngrams["corpus"]
+        bigrams = self.index["bigrams"]
+        lengths = self.index["lengths"]
+        n = len(self._by_id)
+        avgdl = sum(lengths.values()) / n if n else 0
+        if avgdl == 0:
+            return []
+        
+        scores = defaultdict(float)
+        norm_cache = {}  # 同一长度的条目归一化系数相同
+        for gram in grams:
+            postings = bigrams.get(gram)
+            if not postings:
+                continue
+            df = corpus.get(gram, len(postings))
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for eid, tf in postings.items():
+                dl = lengths[eid]
+                k = norm_cache.get(dl)
+                if k is None:
+                    k = norm_cache[dl] = BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl)
+                scores[eid] += idf * tf * (BM25_K1 + 1) / (tf + k)
+        
+        return [self._result(self._by_id[eid], score)
+                for eid, score in heapq.nlargest(top_k, scores.items(), key=lambda x: x[1])]
+    
+    def _search_matrix(self, query, top_k):
+        """numpy 后端: 矩阵打分选出 top_k, 再用精确余弦给出分数"""
+        query_vec = self._tf(query)
         results = []
-        for entry in self.data["entries"]:
-            entry_vec = self._tf(entry["task"])
-            sim = self._cosine_similarity(query_vec, entry_vec)
-            if sim > 0:
-                results.append({
-                    "task": entry["task"],
-                    "result": entry["result"],
-                    "score": sim,
-                    "timestamp": entry.get("timestamp")
-                })
-        
-        # 按相似度排序
+        for eid, _ in self._matrix.top_k(query_vec, top_k):
+            entry = self._by_id[str(eid)]
+            sim = self._cosine_similarity(query_vec, self._tf(entry["task"]))
+            results.append(self._result(entry, sim))
         results.sort(key=lambda x: x["score"], reverse=True)
-        return results[:top_k]
+        return results
+    
+    def _search_lsh(self, query, top_k, bands):
+        """LSH 取同桶候选, 再用余弦精排"""
+        shingles = self._get_ngrams(query, 2)
+        if not shingles:
+            return self._search(query, top_k, False, None, "cosine")  # 查询太短, 没有 bigram
+        
+        with self._lock:
+            if self._lsh is None:
+                self._lsh = MinHashLSH()
+                for entry in self.data["entries"]:
+                    self._lsh.add(entry["id"], self._get_ngrams(entry["task"], 2))
+            candidates = self._lsh.candidates(shingles, bands)
+        
+        # 用倒排表和预存模长精排, 不重新计算候选的词频向量
+        query_vec = self._tf(query)
+        query_norm = math.sqrt(sum(v**2 for v in query_vec.values()))
+        postings = self.index["postings"]
+        terms = [(qw / query_norm, postings[term]) for term, qw in query_vec.items() if term in postings]
+        norms = self.index["norms"]
+        scored = []
+        for eid in map(str, candidates):
+            norm = norms.get(eid)
+            if not norm:
+                continue
+            dot = 0.0
+            for qw, ids in terms:
+                w = ids.get(eid)
+                if w is not None:
+                    dot += qw * w
+            if dot > 0:
+                scored.append((dot / norm, eid))
+        return [self._result(self._by_id[eid], sim)
+                for sim, eid in heapq.nlargest(top_k, scored, key=lambda x: x[0])]
+    
+    def _result(self, entry, score):
+        return {
+            "task": entry["task"],
+            "result": entry["result"],
+            "score": score,
+            "timestamp": entry.get("timestamp")
+        }
     
     def clear(self):
         """清空记忆"""
-        self.data = {"entries": []}
-        self.ngrams = {"corpus": {}}
+        with self._writer():
+            self._append("clear")
+            self._rebuild_index()
+            if self.backend == "numpy":
+                self._matrix = MatrixIndex()
         self.save()
 
 # CLI
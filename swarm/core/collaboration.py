@@ -104,11 +104,14 @@ class AgentCollaboration:
         self.workflow = workflow
     
     def create_context(self, task):
-        task_id = f"{workflow}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        task_id = f"{self.workflow}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
         return Context(self.workflow, task_id)
     
-    def run_chain(self, agents: List[str], task: str, executor_func):
-        """运行 Agent 链"""
+    def run_chain(self, agents: List[str], task: str, executor_func, stage_cache=None):
+        """运行 Agent 链
+        
+        stage_cache: 可选的阶段缓存 (cache.StageCache), 输入 prompt 未变的阶段直接回放
+        """
         ctx = self.create_context(task)
         ctx.set_task(task)
         
@@ -121,11 +124,16 @@ class AgentCollaboration:
             else:
                 prompt = ctx.build_prompt(agent, task)
             
-            # 执行
-            result = executor_func(agent, prompt)
+            # 执行 (阶段缓存命中则回放)
+            result = stage_cache.get(agent, prompt) if stage_cache is not None else None
+            cached = result is not None
+            if not cached:
+                result = executor_func(agent, prompt)
+                if stage_cache is not None and result is not None:
+                    stage_cache.set(agent, prompt, result)
             
             # 保存结果
-            ctx.add_step(agent, result)
+            ctx.add_step(agent, result, {"cached": True} if cached else None)
             
             # 提取共享信息
             if "方案" in result:
@@ -133,7 +141,7 @@ class AgentCollaboration:
             if "代码" in result:
                 ctx.share("last_code", result[:200])
             
-            results.append({"agent": agent, "result": result})
+            results.append({"agent": agent, "result": result, "cached": cached})
         
         return results, ctx
 
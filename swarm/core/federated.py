@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+联合记忆检索 - 跨工作流 / 时间分片并行搜索
+"""
+import os
+import sys
+import heapq
+import itertools
+from multiprocessing.pool import Pool, ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.vector_store import VectorStore
+
+def search_shard(workflow, shard, query, top_k, options):
+    """在单个分片上检索 (模块级函数, 进程池可以直接 pickle)"""
+    vs = VectorStore.open(workflow, shard=shard)
+    results = vs.search(query, top_k, **options)
+    for r in results:
+        r["workflow"] = workflow
+        r["shard"] = shard
+    return results
+
+class FederatedSearch:
+    """把查询分发到多个 VectorStore 分片并行打分, 再用堆合并各分片的 top_k
+    
+    分片 = 每个工作流的主库 + knowledge/shards/ 下的时间分片。
+    余弦得分在分片间可直接比较; BM25 的 idf 按分片各自统计, 合并结果只作参考。
+    """
+    
+    def __init__(self, workflows, include_shards=True, max_workers=4, use_processes=False):
+        self.workflows = list(workflows)
+        self.include_shards = include_shards
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self._pool_obj = None
+    
+    def targets(self):
+        """[(workflow, shard)], shard 为 None 表示主库"""
+        targets = []
+        for workflow in self.workflows:
+            targets.append((workflow, None))
+            if self.include_shards:
+                targets.extend((workflow, shard) for shard in VectorStore.shards(workflow))
+        return targets
+    
+    def _pool(self):
+        # 进程池里每个进程各自缓存 VectorStore, 复用池才不会反复加载
+        # (core/concurrent.py 会遮蔽标准库 concurrent 包, 这里用 multiprocessing.pool)
+        if self._pool_obj is None:
+            pool_cls = Pool if self.use_processes else ThreadPool
+            self._pool_obj = pool_cls(self.max_workers)
+        return self._pool_obj
+    
+    def search(self, query, top_k=5, **options):
+        """联合检索, options 透传给 VectorStore.search (approx/bands/scoring)"""
+        pool = self._pool()
+        pending = [pool.apply_async(search_shard, (workflow, shard, query, top_k, options))
+                   for workflow, shard in self.targets()]
+    
+        shard_results = []
+        for result in pending:
+            try:
+                shard_results.append(result.get())
+            except Exception as e:
+                print(f"分片检索失败: {e}")
+    
+        # 各分片结果已按得分降序, 堆合并后取前 top_k
+        merged = heapq.merge(*shard_results, key=lambda r: -r["score"])
+        return list(itertools.islice(merged, top_k))
+    
+    def close(self):
+        if self._pool_obj is not None:
+            self._pool_obj.close()
+            self._pool_obj.join()
+            self._pool_obj = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+# CLI
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("用法: federated.py <查询> <workflow> [workflow...]")
+        sys.exit(1)
+    
+    with FederatedSearch(sys.argv[2:]) as fs:
+        for r in fs.search(sys.argv[1]):
+            shard = f"/{r['shard']}" if r["shard"] else ""
+            print(f"[{r['score']:.2f}] {r['workflow']}{shard}: {r['task']}")
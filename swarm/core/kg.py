@@ -4,15 +4,40 @@
 """
 import json
 import os
+import sqlite3
+import threading
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import contextmanager
 
 KG_DIR = os.path.expanduser("~/.openclaw/swarm")
 
+def _name_grams(name):
+    """名称的单字和 bigram, 作为子串索引的词项"""
+    return set(name) | {name[i:i+2] for i in range(len(name) - 1)}
+
+def _query_grams(text):
+    # 长度 >= 2 时 bigram 已足够筛选, 单字查询只能用单字
+    return {text[i:i+2] for i in range(len(text) - 1)} or {text}
+
+def _id_seq(node_id):
+    """id 末尾的序号, 无法解析时返回 None"""
+    seq = node_id.rsplit("_", 1)[-1]
+    return int(seq) if seq.isdigit() else None
+
 class KnowledgeGraph:
-    def __init__(self, workflow):
+    """backend: "json" 整个图常驻内存, 存 graph.json; "sqlite" 存 graph.db, 内存占用与图大小无关"""
+    
+    def __new__(cls, workflow, backend="json"):
+        if cls is KnowledgeGraph and backend == "sqlite":
+            return super().__new__(SQLiteKnowledgeGraph)
+        return super().__new__(cls)
+    
+    def __init__(self, workflow, backend="json"):
         self.workflow = workflow
         self.path = f"{KG_DIR}/{workflow}/kg/graph.json"
+        self._batch_depth = 0
+        self._dirty = False
         self.load()
     
     def load(self):
@@ -21,34 +46,124 @@ class KnowledgeGraph:
                 data = json.load(f)
                 self.nodes = data.get("nodes", [])
                 self.edges = data.get("edges", [])
+                self.next_id = data.get("next_id")
         else:
             self.nodes = []
             self.edges = []
+            self.next_id = 0
+        self._build_index()
+    
+    def _build_index(self):
+        """重建 (type, name) / id 索引和邻接表; 旧文件没有 next_id 时从已有 id 的序号推算"""
+        self._by_key = {}
+        self._by_id = {}
+        self._by_type = defaultdict(list)                    # type -> [节点下标]
+        self._name_index = defaultdict(lambda: defaultdict(set))  # type -> gram -> {节点下标}
+        self._out = defaultdict(lambda: defaultdict(list))  # from_id -> relation -> [to_id]
+        self._in = defaultdict(lambda: defaultdict(list))   # to_id -> relation -> [from_id]
+        for pos, n in enumerate(self.nodes):
+            self._index_node(n, pos)
+        for e in self.edges:
+            self._index_edge(e)
+        if self.next_id is None:
+            seqs = [_id_seq(n["id"]) for n in self.nodes]
+            self.next_id = max([s for s in seqs if s is not None], default=-1) + 1
+            self.next_id = max(self.next_id, len(self.nodes))
+    
+    def _index_node(self, node, pos):
+        self._by_key.setdefault((node["type"], node["name"]), node)
+        self._by_id[node["id"]] = node
+        self._by_type[node["type"]].append(pos)
+        postings = self._name_index[node["type"]]
+        for gram in _name_grams(node["name"]):
+            postings[gram].add(pos)
+    
+    def _index_edge(self, edge):
+        self._out[edge["from"]][edge["relation"]].append(edge["to"])
+        self._in[edge["to"]][edge["relation"]].append(edge["from"])
+    
+    def _allocate_id(self, node_type):
+        """单调递增的 id, 删除节点后也不会复用"""
+        node_id = f"{node_type}_{self.next_id}"
+        self.next_id += 1
+        return node_id
     
     def save(self):
-        data = {"nodes": self.nodes, "edges": self.edges}
-        os.makedirs(f"{KG_DIR}/{workflow}/kg", exist_ok=True)
-        with open(self.path, "w") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        """写入 graph.json (先写临时文件再 rename, 不会留下半截文件); batch 内推迟到提交时"""
+        if self._batch_depth:
+            self._dirty = True
+            return
+        data = {"nodes": self.nodes, "edges": self.edges, "next_id": self.next_id}
+        os.makedirs(f"{KG_DIR}/{self.workflow}/kg", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self._dirty = False
+    
+    @contextmanager
+    def batch(self):
+        """事务: 期间的修改只作用于内存, 退出时保存一次; 出现异常则回滚本次修改"""
+        marks = (len(self.nodes), len(self.edges), self.next_id)
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            self._rollback(*marks)
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth and self._dirty:
+            self.save()
+    
+    def _rollback(self, node_count, edge_count, next_id):
+        # 目前只有追加操作, 截断到事务开始时的长度即可
+        if len(self.nodes) != node_count or len(self.edges) != edge_count:
+            del self.nodes[node_count:]
+            del self.edges[edge_count:]
+            self._build_index()
+        self.next_id = next_id
     
     def add_node(self, node_type, name, data=None):
         """添加实体"""
         # 检查是否存在
-        for n in self.nodes:
-            if n["type"] == node_type and n["name"] == name:
-                return n["id"]
+        existing = self._by_key.get((node_type, name))
+        if existing is not None:
+            return existing["id"]
         
         node = {
-            "id": f"{node_type}_{len(self.nodes)}",
+            "id": self._allocate_id(node_type),
             "type": node_type,
             "name": name,
             "data": data or {},
             "created": datetime.now().isoformat()
         }
         self.nodes.append(node)
+        self._index_node(node, len(self.nodes) - 1)
         self.save()
         return node["id"]
     
+    def get_node(self, node_id):
+        return self._by_id.get(node_id)
+    
+    def _has_node(self, node_id):
+        return node_id in self._by_id
+    
+    def find_node(self, node_type, name):
+        """按 (type, name) 精确查找"""
+        return self._by_key.get((node_type, name))
+    
+    def add_nodes(self, items):
+        """批量添加实体, items 为 (type, name) 或 (type, name, data), 只保存一次; 返回 id 列表"""
+        with self.batch():
+            return [self.add_node(*item) for item in items]
+    
+    def add_edges(self, items):
+        """批量添加关系, items 为 (from_id, to_id, relation), 只保存一次"""
+        with self.batch():
+            for item in items:
+                self.add_edge(*item)
+    
     def add_edge(self, from_id, to_id, relation):
         """添加关系"""
         edge = {
@@ -58,18 +173,103 @@ class KnowledgeGraph:
             "created": datetime.now().isoformat()
         }
         self.edges.append(edge)
+        self._index_edge(edge)
         self.save()
     
-    def query(self, node_type=None, name=None):
-        """查询"""
+    def _adjacent(self, node_id, relation=None, direction="out"):
+        """相邻节点 id (可能重复); direction: "out" / "in" / "both" """
+        maps = {"out": (self._out,), "in": (self._in,), "both": (self._out, self._in)}[direction]
+        for adjacency in maps:
+            by_relation = adjacency.get(node_id)
+            if not by_relation:
+                continue
+            if relation is None:
+                for ids in by_relation.values():
+                    yield from ids
+            else:
+                yield from by_relation.get(relation, ())
+    
+    def neighbors(self, node_id, relation=None, direction="out"):
+        """直接相邻的节点 (去重, 保持插入顺序)"""
+        seen = set()
         results = []
-        for n in self.nodes:
-            if node_type and n["type"] != node_type:
+        for other in self._adjacent(node_id, relation, direction):
+            if other not in seen and self._has_node(other):
+                seen.add(other)
+                results.append(self.get_node(other))
+        return results
+    
+    def k_hop(self, node_id, k=2, limit=None, relation=None, direction="both"):
+        """k 跳以内的节点 (广度优先, 不含起点), 每项附带 "hops"; 最多返回 limit 个"""
+        visited = {node_id}
+        frontier = [node_id]
+        results = []
+        for hops in range(1, k + 1):
+            next_frontier = []
+            for current in frontier:
+                for other in self._adjacent(current, relation, direction):
+                    if other in visited or not self._has_node(other):
+                        continue
+                    visited.add(other)
+                    next_frontier.append(other)
+                    results.append({**self.get_node(other), "hops": hops})
+                    if limit is not None and len(results) >= limit:
+                        return results
+            frontier = next_frontier
+            if not frontier:
+                break
+        return results
+    
+    def shortest_path(self, from_id, to_id, relation=None, direction="both"):
+        """最短路径上的节点 id 列表 (含两端), 不连通时返回 None"""
+        if not self._has_node(from_id) or not self._has_node(to_id):
+            return None
+        parents = {from_id: None}
+        queue = deque([from_id])
+        while queue:
+            current = queue.popleft()
+            if current == to_id:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = parents[current]
+                return path[::-1]
+            for other in self._adjacent(current, relation, direction):
+                if other not in parents and self._has_node(other):
+                    parents[other] = current
+                    queue.append(other)
+        return None
+    
+    def _candidates(self, node_type, text):
+        """名称可能包含 text 的节点下标 (未验证)"""
+        types = [node_type] if node_type else list(self._name_index)
+        found = set()
+        for t in types:
+            postings = self._name_index.get(t)
+            if not postings:
                 continue
-            if name and name not in n["name"]:
+            lists = sorted((postings.get(g, ()) for g in _query_grams(text)), key=len)
+            if not lists[0]:
                 continue
-            results.append(n)
-        return results
+            found |= set(lists[0]).intersection(*lists[1:])
+        return found
+    
+    def query(self, node_type=None, name=None, prefix=None, limit=None, offset=0):
+        """查询: name 为子串匹配, prefix 为前缀匹配; 结果按插入顺序, 用 limit/offset 分页"""
+        if name or prefix:
+            positions = self._candidates(node_type, name or prefix)
+            if name and prefix:
+                positions &= self._candidates(node_type, prefix)
+            # n-gram 只能筛出候选, 逐个验证
+            matches = [self.nodes[pos] for pos in sorted(positions)
+                       if (not name or name in self.nodes[pos]["name"])
+                       and (not prefix or self.nodes[pos]["name"].startswith(prefix))]
+        elif node_type:
+            matches = [self.nodes[pos] for pos in self._by_type.get(node_type, ())]
+        else:
+            matches = self.nodes
+        end = offset + limit if limit is not None else None
+        return matches[offset:end]
     
     def get_stats(self):
         return {
@@ -102,9 +302,216 @@ class KnowledgeGraph:
         
         return elements
 
+class SQLiteKnowledgeGraph(KnowledgeGraph):
+    """SQLite 后端 ({KG_DIR}/{workflow}/kg/graph.db), 接口与 KnowledgeGraph 相同
+    
+    节点和边只在查询时读取, (type, name)、from、to、relation 上都有索引;
+    首次打开时若存在 graph.json 会导入。子串查询直接在库里扫描 (instr), 前缀查询走索引范围。
+    """
+    
+    def __init__(self, workflow, backend="sqlite"):
+        self.workflow = workflow
+        self.path = f"{KG_DIR}/{workflow}/kg/graph.db"
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self.load()
+    
+    def load(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fresh = not os.path.exists(self.path)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                pos INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                type TEXT NOT NULL,
+                name TEXT NOT NULL,
+                data TEXT,
+                created TEXT
+            );
+            CREATE TABLE IF NOT EXISTS edges (
+                from_id TEXT NOT NULL,
+                to_id TEXT NOT NULL,
+                relation TEXT NOT NULL,
+                created TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            CREATE INDEX IF NOT EXISTS idx_nodes_name ON nodes(name);
+            CREATE INDEX IF NOT EXISTS idx_edges_from ON edges(from_id, relation);
+            CREATE INDEX IF NOT EXISTS idx_edges_to ON edges(to_id, relation);
+            CREATE INDEX IF NOT EXISTS idx_edges_relation ON edges(relation);
+        """)
+        self._unique_type_name()
+        json_path = f"{KG_DIR}/{self.workflow}/kg/graph.json"
+        if fresh and os.path.exists(json_path):
+            self._import(KnowledgeGraph(self.workflow))
+    
+    def _unique_type_name(self):
+        """(type, name) 唯一索引; 旧库里的普通索引换成唯一索引"""
+        unique = {row[1]: row[2] for row in self._conn.execute("PRAGMA index_list(nodes)")}
+        if unique.get("idx_nodes_type_name"):
+            return
+        with self.batch():
+            self._conn.execute("DROP INDEX IF EXISTS idx_nodes_type_name")
+            try:
+                self._conn.execute("CREATE UNIQUE INDEX idx_nodes_type_name ON nodes(type, name)")
+            except sqlite3.IntegrityError:
+                # 旧库已有重复节点 (边还指向它们), 不擅自删除, 退回普通索引
+                self._conn.execute("CREATE INDEX idx_nodes_type_name ON nodes(type, name)")
+    
+    def _import(self, graph):
+        """从 JSON 图导入, 保留原 id"""
+        with self.batch():
+            self._conn.executemany(
+                "INSERT INTO nodes (id, type, name, data, created) VALUES (?, ?, ?, ?, ?)",
+                [(n["id"], n["type"], n["name"], json.dumps(n.get("data") or {}, ensure_ascii=False),
+                  n.get("created")) for n in graph.nodes])
+            self._conn.executemany(
+                "INSERT INTO edges (from_id, to_id, relation, created) VALUES (?, ?, ?, ?)",
+                [(e["from"], e["to"], e["relation"], e.get("created")) for e in graph.edges])
+            self._set_next_id(graph.next_id)
+    
+    @property
+    def next_id(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        return row[0] if row else 0
+    
+    def _set_next_id(self, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (value,))
+    
+    def save(self):
+        """每次修改已写入库 (batch 内在提交时写入), 保留此方法以兼容 JSON 后端"""
+    
+    @contextmanager
+    def batch(self):
+        """事务: 期间的修改在退出时一次提交; 出现异常则回滚
+        
+        BEGIN IMMEDIATE 开始时就拿写锁: 去重查询与插入、next_id 的读改写不会与其他连接交错
+        """
+        with self._lock:
+            if not self._batch_depth:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._conn.execute("COMMIT")
+    
+    @staticmethod
+    def _row_to_node(row):
+        return {"id": row[0], "type": row[1], "name": row[2],
+                "data": json.loads(row[3]) if row[3] else {}, "created": row[4]}
+    
+    def add_node(self, node_type, name, data=None):
+        """添加实体"""
+        with self.batch():
+            existing = self.find_node(node_type, name)
+            if existing is not None:
+                return existing["id"]
+            next_id = self.next_id
+            node_id = f"{node_type}_{next_id}"
+            self._conn.execute(
+                "INSERT INTO nodes (id, type, name, data, created) VALUES (?, ?, ?, ?, ?)",
+                (node_id, node_type, name, json.dumps(data or {}, ensure_ascii=False),
+                 datetime.now().isoformat()))
+            self._set_next_id(next_id + 1)
+        return node_id
+    
+    def get_node(self, node_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, type, name, data, created FROM nodes WHERE id = ?", (node_id,)).fetchone()
+        return self._row_to_node(row) if row else None
+    
+    def _has_node(self, node_id):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM nodes WHERE id = ?", (node_id,)).fetchone() is not None
+    
+    def find_node(self, node_type, name):
+        """按 (type, name) 精确查找"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, type, name, data, created FROM nodes WHERE type = ? AND name = ? "
+                "ORDER BY pos LIMIT 1", (node_type, name)).fetchone()
+        return self._row_to_node(row) if row else None
+    
+    def add_edge(self, from_id, to_id, relation):
+        """添加关系"""
+        with self.batch():
+            self._conn.execute(
+                "INSERT INTO edges (from_id, to_id, relation, created) VALUES (?, ?, ?, ?)",
+                (from_id, to_id, relation, datetime.now().isoformat()))
+    
+    def _adjacent(self, node_id, relation=None, direction="out"):
+        sides = {"out": (("from_id", "to_id"),), "in": (("to_id", "from_id"),),
+                 "both": (("from_id", "to_id"), ("to_id", "from_id"))}[direction]
+        for key, other in sides:
+            sql = f"SELECT {other} FROM edges WHERE {key} = ?"
+            params = [node_id]
+            if relation is not None:
+                sql += " AND relation = ?"
+                params.append(relation)
+            with self._lock:
+                rows = self._conn.execute(sql + " ORDER BY rowid", params).fetchall()
+            for row in rows:
+                yield row[0]
+    
+    def query(self, node_type=None, name=None, prefix=None, limit=None, offset=0):
+        """查询: name 为子串匹配, prefix 为前缀匹配; 结果按插入顺序, 用 limit/offset 分页"""
+        clauses, params = [], []
+        if node_type:
+            clauses.append("type = ?")
+            params.append(node_type)
+        if prefix:
+            # 前缀转成索引上的范围查询
+            clauses.append("name >= ? AND name < ?")
+            params += [prefix, prefix + "\U0010ffff"]
+        if name:
+            clauses.append("instr(name, ?) > 0")
+            params.append(name)
+        sql = "SELECT id, type, name, data, created FROM nodes"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY pos LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._row_to_node(row) for row in rows]
+    
+    def get_stats(self):
+        with self._lock:
+            nodes = self._conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+            edges = self._conn.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
+            types = [row[0] for row in self._conn.execute("SELECT DISTINCT type FROM nodes")]
+        return {"nodes": nodes, "edges": edges, "types": types}
+    
+    def to_cytoscape(self):
+        """转换为 Cytoscape 格式 (用于可视化)"""
+        elements = []
+        with self._lock:
+            for node_id, node_type, name in self._conn.execute(
+                    "SELECT id, type, name FROM nodes ORDER BY pos"):
+                elements.append({"data": {"id": node_id, "label": name, "type": node_type}})
+            for from_id, to_id, relation in self._conn.execute(
+                    "SELECT from_id, to_id, relation FROM edges ORDER BY rowid"):
+                elements.append({"data": {"source": from_id, "target": to_id, "label": relation}})
+        return elements
+    
+    def close(self):
+        self._conn.close()
+
 # CLI
 if __name__ == "__main__":
     import sys
     workflow = sys.argv[1] if len(sys.argv) > 1 else "artgroup"
-    kg = KnowledgeGraph(workflow)
+    backend = sys.argv[2] if len(sys.argv) > 2 else "json"
+    kg = KnowledgeGraph(workflow, backend=backend)
     print(json.dumps(kg.get_stats(), indent=2))
@@ -77,8 +77,23 @@ class RetryHandler:
         """获取应对策略"""
         return self.config.STRATEGIES.get(error_type, ["换Agent重试"])
     
-    def execute_with_retry(self, agent: str, task: str, execute_func: Callable) -> dict:
-        """带重试的执行"""
+    def execute_with_retry(self, agent: str, task: str, execute_func: Callable, stage_cache=None) -> dict:
+        """带重试的执行
+        
+        stage_cache: 可选的阶段缓存 (cache.StageCache), 按 (agent, task) 回放成功结果;
+        结果记在实际产出它的 Agent 名下, 备选 Agent 的结果不会冒充原 agent 命中
+        """
+        if stage_cache is not None:
+            cached = stage_cache.get(agent, task)
+            if cached is not None:
+                return {
+                    "success": True,
+                    "agent": agent,
+                    "result": cached,
+                    "attempts": [],
+                    "cached": True
+                }
+        
         attempts = []
         current_agent = agent
         error_type = None
@@ -88,13 +103,16 @@ class RetryHandler:
                 print(f"  尝试 {attempt + 1}/{self.max_retries} (Agent: {current_agent})")
                 
                 result = execute_func(current_agent, task)
+                if stage_cache is not None and result is not None:
+                    stage_cache.set(current_agent, task, result)
                 
                 # 成功
                 return {
                     "success": True,
                     "agent": current_agent,
                     "result": result,
-                    "attempts": attempts
+                    "attempts": attempts,
+                    "cached": False
                 }
             
             except Exception as e:
@@ -123,7 +141,8 @@ class RetryHandler:
             "agent": current_agent,
             "error": error_type,
             "attempts": attempts,
-            "strategies": self.get_strategy(error_type)
+            "strategies": self.get_strategy(error_type),
+            "cached": False
         }
     
     def save_history(self, workflow: str, result: dict):